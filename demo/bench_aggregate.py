@@ -0,0 +1,41 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Compare numpytorch.aggregate (torch index_add/scatter_reduce) against
+the npg.aggregate round trip it replaces.
+"""
+
+import numpy as np
+import numpy_groupies as npg
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+
+
+def aggregate_npg(subs, val, func='sum'):
+    """Previous implementation: via numpy and npg.aggregate"""
+    return npt.tensor(npg.aggregate(npt.npy(subs), npt.npy(val), func=func))
+
+
+def main(ns=(10 ** 6, 10 ** 7), size=(100, 100), repeat=3,
+         device=None):
+    """
+    :param ns: number of elements; add 10 ** 8 if memory allows.
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('device: %s, size: %s' % (device, size))
+    for n in ns:
+        subs = torch.stack([torch.randint(s, (n,), device=device)
+                            for s in size])
+        val = torch.rand(n, device=device, dtype=torch.float32)
+        for func in ('sum', 'mean', 'max', 'min', 'count'):
+            t_npg = np2.timeit(aggregate_npg, subs, val, func,
+                               repeat=repeat) / repeat
+            t_npt = np2.timeit(npt.aggregate, subs, val, func,
+                               repeat=repeat) / repeat
+            print('n=%9d %5s: npg %8.4fs, torch %8.4fs'
+                  % (n, func, t_npg, t_npt))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Per-call overhead of numpytorch's broadcast helpers (repeat_all,
+expand_all, max_shape) against the versions they replace, which did
+the shape math with tensors.
+"""
+
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+
+
+def repeat_all_tensor(*args, shape=None, use_expand=False):
+    """Previous implementation: shape math with tensors"""
+    ndim = args[0].ndimension()
+    max_shape = torch.ones(ndim, dtype=torch.long)
+    for arg in args:
+        max_shape, _ = torch.max(torch.cat([
+            torch.tensor(arg.shape)[None, :], max_shape[None, :]],
+            dim=0), dim=0)
+    if shape is None:
+        shape = max_shape
+    else:
+        shape = torch.tensor(shape)
+        is_free = shape == -1
+        shape[is_free] = max_shape[is_free]
+
+    out = []
+    for arg in args:
+        if use_expand:
+            out.append(arg.expand(*tuple(shape)))
+        else:
+            out.append(arg.repeat(
+                *tuple((shape / torch.tensor(arg.shape)).long())))
+    return tuple(out)
+
+
+def max_shape_tensor(shapes):
+    """Previous implementation: stacks shapes into a tensor"""
+    return torch.Size(
+        torch.max(torch.stack([torch.tensor(v) for v in shapes]), dim=0)[0]
+    )
+
+
+def main(repeat=10000):
+    x = torch.rand(100, 1)
+    mu = torch.rand(1, 50)
+    std = torch.rand(1, 50)
+    shapes = [x.shape, mu.shape, std.shape]
+
+    for (name, fun_old, kw_old, fun_new, args) in [
+        ('expand_all', repeat_all_tensor, {'use_expand': True},
+         npt.expand_all, (x, mu, std)),
+        ('repeat_all', repeat_all_tensor, {}, npt.repeat_all, (x, mu, std)),
+        ('max_shape', max_shape_tensor, {}, npt.max_shape, (shapes,)),
+    ]:
+        out_old = fun_old(*args, **kw_old)
+        out_new = fun_new(*args)
+        if name == 'max_shape':
+            assert out_old == out_new
+        else:
+            assert all([torch.equal(a, b) for a, b in zip(out_old, out_new)])
+
+        t_old = np2.timeit(fun_old, *args, repeat=repeat, **kw_old) / repeat
+        t_new = np2.timeit(fun_new, *args, repeat=repeat) / repeat
+        print('%10s: tensor shape math %7.2f us/call, now %7.2f us/call'
+              % (name, t_old * 1e6, t_new * 1e6))
+
+
+if __name__ == '__main__':
+    main()
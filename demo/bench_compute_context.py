@@ -0,0 +1,49 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Compare float32 against the float64 baseline under
+numpytorch.compute_context: speed and error of the RT distribution
+kernels on a time grid.
+"""
+
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+
+
+def pmfs(n_t=2000, n_cond=2000, seed=0):
+    """Build inputs with npt constructors so that they follow the context"""
+    gen = torch.Generator().manual_seed(seed)
+    t = npt.linspace(0., 4., n_t)[:, None]
+    mean = npt.tensor(torch.rand(1, n_cond, generator=gen) + .5)
+    std = npt.tensor(torch.rand(1, n_cond, generator=gen) * .3 + .1)
+    grid = npt.pmf_grid(t)
+    return (
+        npt.inv_gaussian_pmf_mean_stdev(grid, mean, std),
+        npt.lognorm_pmf(grid, mean, std),
+    )
+
+
+def main(repeat=5, device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('device: %s' % device)
+
+    res = {}
+    for dtype in (torch.float64, torch.float32):
+        with npt.compute_context(device=device, dtype=dtype):
+            t_el, out = np2.timeit(pmfs, repeat=repeat, return_out=True)
+        res[dtype] = out
+        print('%s: %8.4fs' % (dtype, t_el / repeat))
+
+    for name, p64, p32 in zip(['inv_gaussian', 'lognorm'],
+                              res[torch.float64], res[torch.float32]):
+        assert p32.dtype == torch.float32
+        err = (p32.double() - p64).abs()
+        print('%s: max abs error of float32 %g (max p %g), '
+              'max error in sum %g'
+              % (name, err.max(), p64.max(),
+                 (p32.double().sum(0) - p64.sum(0)).abs().max()))
+
+
+if __name__ == '__main__':
+    main()
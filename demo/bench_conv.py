@@ -0,0 +1,61 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Crossover of direct, FFT and overlap-add convolution in
+numpytorch.conv_t and np2.convolve_time, to set numpytorch.conv_algo.
+"""
+
+import numpy as np
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+
+
+def bench_conv_t(nts=(100, 1000, 10000), n_kernels=(8, 32, 128, 1000, 10000),
+                 n_batch=16, repeat=5, backward=True):
+    print('conv_t: [batch=%d, time], forward%s; seconds per call'
+          % (n_batch, ' + backward' if backward else ''))
+    print('%6s %6s %9s %9s %9s %6s' % ('nt', 'nk', 'direct', 'fft', 'oa',
+                                        'auto'))
+    for nt in nts:
+        for nk in n_kernels:
+            if nk > nt:
+                continue
+            p = torch.rand(n_batch, nt, requires_grad=backward)
+            kernel = torch.rand(nk, requires_grad=backward)
+
+            def run(algo):
+                out = npt.conv_t(p, kernel, algo=algo)
+                if backward:
+                    out.sum().backward()
+                return out
+
+            t = {algo: np2.timeit(run, algo, repeat=repeat) / repeat
+                 for algo in ('direct', 'fft', 'oa')}
+            print('%6d %6d %9.2e %9.2e %9.2e %6s' % (
+                nt, nk, t['direct'], t['fft'], t['oa'],
+                npt.conv_algo(nt, nk)))
+
+
+def bench_convolve_time(nts=(100, 1000, 10000),
+                        n_kernels=(8, 32, 128, 1000, 10000),
+                        n_batch=16, repeat=5):
+    print('convolve_time: [time, batch=%d]; seconds per call' % n_batch)
+    print('%6s %6s %9s %9s %9s %6s' % ('nt', 'nk', 'direct', 'fft', 'oa',
+                                        'auto'))
+    for nt in nts:
+        for nk in n_kernels:
+            if nk > nt:
+                continue
+            src = np.random.rand(nt, n_batch)
+            kernel = np.random.rand(nk)
+            t = {algo: np2.timeit(np2.convolve_time, src, kernel,
+                                  algo=algo, repeat=repeat) / repeat
+                 for algo in ('direct', 'fft', 'oa')}
+            print('%6d %6d %9.2e %9.2e %9.2e %6s' % (
+                nt, nk, t['direct'], t['fft'], t['oa'],
+                npt.conv_algo(nt, nk)))
+
+
+if __name__ == '__main__':
+    bench_conv_t()
+    bench_convolve_time()
@@ -0,0 +1,93 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Compare np2.discretize/quantilize against the previous mask/rank-based
+implementations on large inputs.
+"""
+
+import numpy as np
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+
+
+def discretize_mask(v, cutoff):
+    """Previous implementation: a boolean mask per cutoff"""
+    v = np.array(v)
+    ix = np.zeros(v.shape, dtype=np.int64)
+
+    cutoff = list(cutoff)
+    cutoff.append(np.inf)
+    n = len(cutoff)
+
+    for ii in range(1, n):
+        ix[(v >= cutoff[ii - 1]) & (v < cutoff[ii])] = ii
+
+    ix[v >= cutoff[-1]] = n - 1
+    return ix
+
+
+def quantilize_rank(v, n_quantile=5):
+    """
+    Previous implementation: full ordinal ranks.
+    NaNs rank last, as in scipy < 1.10's rankdata; newer versions
+    return NaN ranks, so the ranks are taken from a stable argsort here.
+    """
+    v = np.array(v)
+    n = v.size
+    rank = np.empty(n)
+    rank[np.argsort(v, kind='stable')] = np.arange(1, n + 1)
+    return np.int32(np.ceil(rank / n * n_quantile) - 1)
+
+
+def quantilize_unique(v, n_quantile=5):
+    """Previous implementation with few unique values: uniquetol"""
+    x, ix = np2.uniquetol(np.array(v), return_inverse=True)
+    if len(x) > n_quantile:
+        return quantilize_rank(v, n_quantile)
+    return ix
+
+
+def check_nan(n=10000, n_quantile=10):
+    """NaNs bin after the other values, as in the previous versions"""
+    v = np.array([1, 2, 3, np.nan, 1, 2, 3, 2.])
+    for k in (3, 5):
+        assert np.all(np2.quantilize(v, k) == quantilize_unique(v, k))
+    v = np.random.randn(n)
+    v[np.random.rand(n) < .1] = np.nan
+    v_tie = np.round(v * 2)
+    for v1 in (v, v_tie):
+        same = np.all(np2.quantilize(v1, n_quantile, fallback_to_unique=False)
+                      == quantilize_rank(v1, n_quantile))
+        print('quantilize with NaN: same: %s' % same)
+        assert same
+
+
+def main(ns=(10 ** 5, 10 ** 6, 10 ** 7), n_cutoff=20, n_quantile=10):
+    for n in ns:
+        v = np.random.randn(n)
+        cutoff = np.linspace(-2, 2, n_cutoff)
+
+        t_old, ix_old = np2.timeit(discretize_mask, v, cutoff,
+                                   return_out=True)
+        t_new, ix_new = np2.timeit(np2.discretize, v, cutoff,
+                                   return_out=True)
+        print('discretize   n=%9d: mask %7.3fs, searchsorted %7.3fs, '
+              'same: %s' % (n, t_old, t_new, np.all(ix_old == ix_new)))
+
+        t_old, ix_old = np2.timeit(quantilize_rank, v, n_quantile,
+                                   return_out=True)
+        t_new, ix_new = np2.timeit(np2.quantilize, v, n_quantile,
+                                   return_out=True)
+        print('quantilize   n=%9d: rank %7.3fs, partition    %7.3fs, '
+              'same: %s' % (n, t_old, t_new, np.all(ix_old == ix_new)))
+
+        vt = torch.tensor(v)
+        t_new, ix_t = np2.timeit(npt.quantilize, vt, n_quantile,
+                                 return_out=True)
+        print('npt.quantilize n=%9d:                 sort %7.3fs, '
+              'same: %s' % (n, t_new, np.all(ix_old == npt.npy(ix_t))))
+
+
+if __name__ == '__main__':
+    check_nan()
+    main()
@@ -0,0 +1,86 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Per-call cost of HypersphericalUniform's entropy, log_prob and sample
+(with and without out=), and of the closed-form KL(vMF || uniform),
+against the previous implementation, as called once per batch in a
+VAE loop.
+"""
+
+import math
+import torch
+from lib.pylabyk import np2
+from lib.pylabyk.hyperspherical_vae.distributions import \
+    von_mises_fisher as vmf, hyperspherical_uniform as hyu
+from lib.pylabyk.hyperspherical_vae.ops.ive import ive
+
+
+def log_surface_area_prev(dim, device='cpu'):
+    """Previous implementation: lgamma of a new tensor on every call"""
+    return math.log(2) + ((dim + 1) / 2) * math.log(math.pi) - torch.lgamma(
+        torch.Tensor([(dim + 1) / 2]).to(device))
+
+
+def log_prob_prev(dim, x):
+    return - torch.ones(x.shape[:-1]) * log_surface_area_prev(dim)
+
+
+def sample_prev(dim, shape):
+    output = torch.distributions.Normal(0, 1).sample(
+        shape + torch.Size([dim + 1]))
+    return output / output.norm(dim=-1, keepdim=True)
+
+
+def kl_prev(q, dim):
+    """Previous: -entropy of vMF (three ive calls) + log surface area"""
+    m = dim + 1
+    scale = q.scale
+    ratio = ive(m / 2, scale) / ive(m / 2 - 1, scale)
+    log_norm = - ((m / 2 - 1) * torch.log(scale)
+                  - (m / 2) * math.log(2 * math.pi)
+                  - (scale + torch.log(ive(m / 2 - 1, scale))))
+    entropy = (- scale * ratio + log_norm).view(-1)
+    return - entropy + log_surface_area_prev(dim)
+
+
+def main(dim=15, n_batch=128, repeat=2000):
+    p = hyu.HypersphericalUniform(dim)
+    loc = torch.nn.functional.normalize(torch.randn(n_batch, dim + 1), dim=-1)
+    scale = torch.rand(n_batch, 1) * 50 + 1
+    q = vmf.VonMisesFisher(loc, scale)
+    q_table = vmf.VonMisesFisher(loc, scale, lookup_table=True)
+    x = p.sample(n_batch)
+    shape = torch.Size([n_batch])
+    out = torch.empty(n_batch, dim + 1)
+
+    err = (torch.distributions.kl_divergence(q, p) - kl_prev(q, dim)
+           ).abs().max()
+    for name, t_prev, t_now in [
+        ('entropy',
+         np2.timeit(log_surface_area_prev, dim, repeat=repeat),
+         np2.timeit(p.entropy, repeat=repeat)),
+        ('log_prob',
+         np2.timeit(log_prob_prev, dim, x, repeat=repeat),
+         np2.timeit(p.log_prob, x, repeat=repeat)),
+        ('sample',
+         np2.timeit(sample_prev, dim, shape, repeat=repeat),
+         np2.timeit(p.sample, shape, repeat=repeat)),
+        ('sample(out=)',
+         np2.timeit(sample_prev, dim, shape, repeat=repeat),
+         np2.timeit(p.sample, shape, out=out, repeat=repeat)),
+        ('KL',
+         np2.timeit(kl_prev, q, dim, repeat=repeat),
+         np2.timeit(torch.distributions.kl_divergence, q, p,
+                    repeat=repeat)),
+        ('KL (table)',
+         np2.timeit(kl_prev, q, dim, repeat=repeat),
+         np2.timeit(torch.distributions.kl_divergence, q_table, p,
+                    repeat=repeat)),
+    ]:
+        print('%13s: previous %7.2f us/call, now %7.2f us/call'
+              % (name, t_prev / repeat * 1e6, t_now / repeat * 1e6))
+    print('max abs difference in KL (float32): %g' % err)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Accuracy vs. speed of VonMisesFisher's log normalizer and entropy
+with lookup_table=True (cubic Hermite interpolation of log ive and
+I_{v+1} / I_v) against calling ive on every evaluation.
+"""
+
+import torch
+from lib.pylabyk import np2
+from lib.pylabyk.hyperspherical_vae.distributions import \
+    von_mises_fisher as vmf
+
+
+def log_norm_entropy(m, scale, lookup_table):
+    scale = scale.detach().requires_grad_()
+    loc = torch.zeros(scale.shape[0], m, dtype=scale.dtype,
+                      device=scale.device)
+    loc[:, 0] = 1.
+    d = vmf.VonMisesFisher(loc, scale, lookup_table=lookup_table)
+    log_norm = d._log_normalization()
+    entropy = d.entropy()
+    (log_norm.sum() + entropy.sum()).backward()
+    return log_norm.detach(), entropy.detach(), scale.grad
+
+
+def main(ms=(3, 16, 128), ns=(100, 10000, 1000000), repeat=10,
+         device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('device: %s' % device)
+    for m in ms:
+        # build the table once, outside the timing
+        log_norm_entropy(m, torch.ones(1, 1, dtype=torch.double), True)
+        for n in ns:
+            scale = torch.logspace(-2, 3, n, dtype=torch.double,
+                                   device=device)[:, None]
+            res_ive = log_norm_entropy(m, scale, False)
+            res_tab = log_norm_entropy(m, scale, True)
+            err = [(a - b).abs().max().item()
+                   for a, b in zip(res_ive, res_tab)]
+
+            t_ive = np2.timeit(log_norm_entropy, m, scale, False,
+                               repeat=repeat) / repeat
+            t_tab = np2.timeit(log_norm_entropy, m, scale, True,
+                               repeat=repeat) / repeat
+            print('m=%3d n=%8d: ive %8.5fs, table %8.5fs; max abs error: '
+                  'log normalizer %.2g, entropy %.2g, gradient %.2g'
+                  % (m, n, t_ive, t_tab, *err))
+
+
+if __name__ == '__main__':
+    main()
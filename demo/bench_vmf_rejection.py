@@ -0,0 +1,80 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Throughput of VonMisesFisher's rejection sampler for the component
+along the mean direction (m != 3): blocks of candidates with
+compaction, against the previous loop that redraws the full shape
+until every element is accepted.
+"""
+
+import math
+import torch
+from lib.pylabyk import np2
+from lib.pylabyk.hyperspherical_vae.distributions import \
+    von_mises_fisher as vmf
+
+
+def params(m, scale):
+    c = torch.sqrt((4 * (scale ** 2)) + (m - 1) ** 2)
+    b = (m - 1) / (2 * scale + c)
+    a = (m - 1 + 2 * scale + c) / 4
+    d = (4 * a * b) / (1 + b) - (m - 1) * math.log(m - 1)
+    return b, a, d
+
+
+def while_loop_full(m, scale, shape):
+    """Previous implementation (with ~accept for bool tensors)"""
+    b, a, d = params(m, scale)
+    b, a, d = [e.repeat(*shape, *([1] * len(scale.shape))) for e in (b, a, d)]
+    w, e, bool_mask = torch.zeros_like(b), torch.zeros_like(b), \
+        torch.ones_like(b) == 1
+    shape = shape + torch.Size(scale.shape)
+    n_iter = 0
+    while bool_mask.sum() != 0:
+        e_ = torch.distributions.Beta((m - 1) / 2, (m - 1) / 2).sample(
+            shape[:-1]).reshape(shape).to(b.dtype)
+        u = torch.distributions.Uniform(0, 1).sample(shape)
+
+        w_ = (1 - (1 + b) * e_) / (1 - (1 - b) * e_)
+        t = (2 * a * b) / (1 - (1 - b) * e_)
+
+        accept = ((m - 1) * t.log() - t + d) > torch.log(u)
+        reject = ~accept
+
+        w[bool_mask * accept] = w_[bool_mask * accept]
+        e[bool_mask * accept] = e_[bool_mask * accept]
+
+        bool_mask[bool_mask * accept] = reject[bool_mask * accept]
+        n_iter += 1
+    return e, w
+
+
+def while_loop_block(m, scale, shape):
+    loc = torch.zeros(scale.shape[0], m, dtype=scale.dtype)
+    loc[:, 0] = 1.
+    d = vmf.VonMisesFisher(loc, scale)
+    # the private sampler, to time the rejection step alone
+    return d._VonMisesFisher__sample_w_rej(shape)
+
+
+def main(ms=(2, 5, 16, 128), scales=(1., 10., 100., 1000.),
+         n_samp=10000, n_batch=10, repeat=5):
+    shape = torch.Size([n_samp])
+    for m in ms:
+        for s in scales:
+            scale = torch.full((n_batch, 1), s, dtype=torch.double)
+            w_full = while_loop_full(m, scale, shape)[1]
+            w_block = while_loop_block(m, scale, shape)
+            t_full = np2.timeit(while_loop_full, m, scale, shape,
+                                repeat=repeat) / repeat
+            t_block = np2.timeit(while_loop_block, m, scale, shape,
+                                 repeat=repeat) / repeat
+            n = n_samp * n_batch
+            print('m=%3d scale=%6g: full redraw %6.2f M/s, blocks %6.2f M/s;'
+                  ' mean w %.4f vs %.4f'
+                  % (m, s, n / t_full / 1e6, n / t_block / 1e6,
+                     w_full.mean(), w_block.mean()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+VonMisesFisher.rsample called repeatedly with the same shape, as in a
+VAE training loop (forward + backward): the Best-Fisher sampler for
+m == 2, the fused Householder reflection and the reused noise buffer,
+against the previous path (rejection via Beta for m == 2, full Normal
+draw with transposes, and reflection of the concatenated sample).
+"""
+
+import torch
+from lib.pylabyk import np2
+from lib.pylabyk.hyperspherical_vae.distributions import \
+    von_mises_fisher as vmf
+
+
+def rsample_prev(d, shape):
+    """Previous implementation, with the current samplers for w"""
+    m = d.loc.shape[-1]
+    if m == 3:
+        w = d._VonMisesFisher__sample_w3(shape)
+    else:
+        w = d._VonMisesFisher__sample_w_rej(shape)
+    v = (torch.distributions.Normal(0, 1).sample(
+        shape + torch.Size(d.loc.shape)).to(d.device).transpose(0, -1)[1:]
+         ).transpose(0, -1)
+    v = v / v.norm(dim=-1, keepdim=True)
+    w_ = torch.sqrt(torch.clamp(1 - (w ** 2), 1e-10))
+    x = torch.cat((w, w_ * v), -1)
+    e1 = torch.Tensor([1.] + [0] * (m - 1)).to(d.device)
+    u = e1 - d.loc
+    u = u / (u.norm(dim=-1, keepdim=True) + 1e-5)
+    return (x - 2 * (x * u).sum(-1, keepdim=True) * u).type(d.dtype)
+
+
+def rsample_now(d, shape):
+    return d.rsample(shape)
+
+
+def step(fun, loc, scale, shape):
+    loc = loc.detach().requires_grad_()
+    scale = scale.detach().requires_grad_()
+    d = vmf.VonMisesFisher(loc, scale)
+    fun(d, shape)[..., 0].sum().backward()
+    return scale.grad
+
+
+def main(ms=(2, 3, 5, 16, 128), n_samp=100, n_batch=1000, scale=10.,
+         repeat=20, device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('device: %s' % device)
+    shape = torch.Size([n_samp])
+    for m in ms:
+        loc = torch.nn.functional.normalize(
+            torch.randn(n_batch, m, dtype=torch.double, device=device),
+            dim=-1)
+        scales = torch.full((n_batch, 1), scale, dtype=torch.double,
+                            device=device)
+        t_prev = np2.timeit(step, rsample_prev, loc, scales, shape,
+                            repeat=repeat) / repeat
+        t_now = np2.timeit(step, rsample_now, loc, scales, shape,
+                           repeat=repeat) / repeat
+        print('m=%3d, %d samples: previous %7.4fs, now %7.4fs per step'
+              % (m, n_samp * n_batch, t_prev, t_now))
+
+
+if __name__ == '__main__':
+    main()
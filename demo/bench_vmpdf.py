@@ -0,0 +1,57 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+Compare numpytorch.vmpdf_log (torch-native log I0e) against
+constructing hyperspherical_vae's VonMisesFisher, whose log normalizer
+goes through scipy's ive on the CPU.
+"""
+
+import torch
+from lib.pylabyk import np2, numpytorch as npt
+from lib.pylabyk.hyperspherical_vae.distributions import \
+    von_mises_fisher as vmf
+
+
+def logpdf_vmf(x, mu, scale):
+    """Previous path: via VonMisesFisher"""
+    return vmf.VonMisesFisher(mu, scale).log_prob(x)
+
+
+def forward_backward(fun, x, mu, scale):
+    scale = scale.detach().requires_grad_()
+    fun(x, mu, scale).sum().backward()
+    return scale.grad
+
+
+def main(ns=(100, 10000, 1000000), n_scale=100, repeat=20, device=None):
+    """
+    :param ns: number of points on the circle
+    :param n_scale: number of concentrations, evaluated in one batch
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('device: %s' % device)
+    for n in ns:
+        x = npt.prad2unitvec(torch.rand(n, 1, device=device,
+                                        dtype=torch.float64))
+        mu = npt.prad2unitvec(torch.rand(n_scale, device=device,
+                                         dtype=torch.float64))
+        scale = torch.rand(n_scale, 1, device=device,
+                           dtype=torch.float64) * 10.
+        n1 = max(1, n // n_scale)
+        x = x[:n1]
+
+        err = (npt.vmpdf_log(x, mu, scale)
+               - logpdf_vmf(x, mu, scale)).abs().max()
+        for name, fun in [('forward', lambda f: f(x, mu, scale)),
+                          ('forward+backward',
+                           lambda f: forward_backward(f, x, mu, scale))]:
+            t_vmf = np2.timeit(fun, logpdf_vmf, repeat=repeat) / repeat
+            t_npt = np2.timeit(fun, npt.vmpdf_log, repeat=repeat) / repeat
+            print('n=%8d %16s: VonMisesFisher %8.5fs, vmpdf_log %8.5fs'
+                  % (n1 * n_scale, name, t_vmf, t_npt))
+        print('max abs difference in log p: %g' % err)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,19 @@ def print_demo(p, fun):
     print(out[0].sum(), out[1].sum())
 
 
+def check_grad_many_ids(n_id=20, n_value=30):
+    """Gradients stay finite with many ids and zeros in p"""
+    for dtype in (torch.float32, torch.float64):
+        p = torch.rand(n_id, n_value, dtype=dtype)
+        p[:, -1] = 0.
+        p.requires_grad_()
+        p_min, p_1st = npt.min_distrib(p)
+        (p_min.sum() + p_1st.sum()).backward()
+        n_nan = int(torch.isnan(p.grad).sum())
+        print('%s, %d ids: %d NaN gradients' % (dtype, n_id, n_nan))
+        assert n_nan == 0
+
+
 if __name__ == '__main__':
     for p, fun in [
         (torch.tensor([
@@ -52,3 +65,4 @@ if __name__ == '__main__':
         ]) * 0.1, npt.max_distrib),
     ]:
         print_demo(p, fun)
+    check_grad_many_ids()
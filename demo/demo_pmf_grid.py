@@ -0,0 +1,37 @@
+#  Copyright (c) 2020. Yul HR Kang. hk2699 at caa dot columbia dot edu.
+
+"""
+pmf_grid() reuses the grid terms while x is alive and unchanged, and
+drops them once x is garbage collected.
+"""
+
+import gc
+import torch
+from lib.pylabyk import numpytorch as npt
+
+
+def check_reuse():
+    x = torch.linspace(0., 4., 100)[:, None]
+    grid = npt.pmf_grid(x)
+    assert npt.pmf_grid(x) is grid
+    x[0] = 0.
+    assert npt.pmf_grid(x) is not grid
+    print('reused while unchanged, rebuilt after an in-place change')
+
+
+def check_eviction(n_grid=100):
+    n0 = len(npt._pmf_grid_cache)
+    for _ in range(n_grid):
+        x = torch.linspace(0., 4., 100)[:, None]
+        npt.lognorm_pmf(x, torch.ones(1, 3), torch.ones(1, 3) * .5)
+        del x
+        gc.collect()
+    n1 = len(npt._pmf_grid_cache)
+    print('cache entries after %d grids: %d (before: %d)'
+          % (n_grid, n1, n0))
+    assert n1 <= n0 + 1
+
+
+if __name__ == '__main__':
+    check_reuse()
+    check_eviction()
@@ -1,10 +1,19 @@
 
 import math
 import torch
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _log_surface_area(dim):
+    """log surface area of the unit sphere S^dim in R^(dim + 1)"""
+    return math.log(2) + ((dim + 1) / 2) * math.log(math.pi) - math.lgamma(
+        (dim + 1) / 2)
 
 
 class HypersphericalUniform(torch.distributions.Distribution):
 
+    arg_constraints = {}
     support = torch.distributions.constraints.real
     has_rsample = False
     _mean_carrier_measure = 0
@@ -21,23 +30,42 @@ class HypersphericalUniform(torch.distributions.Distribution):
     def device(self, val):
         self._device = val if isinstance(val, torch.device) else torch.device(val)
 
-    def __init__(self, dim, validate_args=None, device="cpu"):
+    def __init__(self, dim, validate_args=None, device="cpu", dtype=None):
         super(HypersphericalUniform, self).__init__(torch.Size([dim]), validate_args=validate_args)
         self._dim = dim
         self.device = device
+        self.dtype = torch.get_default_dtype() if dtype is None else dtype
 
-    def sample(self, shape=torch.Size()):
-        output = torch.distributions.Normal(0, 1).sample(
-            (shape if isinstance(shape, torch.Size) else torch.Size([shape])) + torch.Size([self._dim + 1])).to(self.device)
+    def sample(self, shape=torch.Size(), out=None):
+        """
+        :param out: if given, a tensor of shape shape + [dim + 1], with
+        the distribution's dtype and device, that the samples are written
+        into (and returned), e.g., to reuse it across calls in a training
+        loop.
+        """
+        shape = (shape if isinstance(shape, torch.Size) else torch.Size([shape])) + torch.Size([self._dim + 1])
+        if out is None:
+            output = torch.randn(shape, dtype=self.dtype, device=self.device)
+        else:
+            if out.shape != shape:
+                raise ValueError('Unsupported out.shape=%s' % (out.shape,))
+            if out.dtype != self.dtype:
+                raise ValueError('Unsupported out.dtype=%s' % out.dtype)
+            if out.device != self.device:
+                raise ValueError('Unsupported out.device=%s' % out.device)
+            output = out.normal_()
 
-        return output / output.norm(dim=-1, keepdim=True)
+        return output.div_(output.norm(dim=-1, keepdim=True))
 
     def entropy(self):
         return self.__log_surface_area()
 
     def log_prob(self, x):
-        return - torch.ones(x.shape[:-1], device=self.device) * self.__log_surface_area()
+        return torch.full(x.shape[:-1], -_log_surface_area(self._dim),
+                          dtype=self.dtype, device=self.device)
 
     def __log_surface_area(self):
-        return math.log(2) + ((self._dim + 1) / 2) * math.log(math.pi) - torch.lgamma(
-            torch.Tensor([(self._dim + 1) / 2], device=self.device))
+        # A new tensor each call, so that in-place ops on the result
+        # don't change other instances'; only the float is cached.
+        return torch.full([1], _log_surface_area(self._dim),
+                          dtype=self.dtype, device=self.device)
@@ -1,9 +1,74 @@
 import math
+import threading
 import torch
 from torch.distributions.kl import register_kl
 
-from hyperspherical_vae.ops.ive import ive
-from hyperspherical_vae.distributions import HypersphericalUniform
+from ..ops.ive import _log_ive, _log_ive_pair
+from ..ops.log_ive_table import LogIveTable, log_ive_table
+from .hyperspherical_uniform import HypersphericalUniform, _log_surface_area
+
+
+# Rejection sampler: bounds for the acceptance rate, the probability that
+# an element is left without an accepted candidate after a block, and the
+# max number of candidates per element in a block.
+_REJECTION_P_ACCEPT_MIN = .01
+_REJECTION_P_ACCEPT_MAX = .99
+_REJECTION_P_LEFT = .05
+_REJECTION_MAX_CAND = 64
+
+# Per-thread scratch tensors for the random draws in rsample
+_buffers = threading.local()
+_BUFFERS_MAX = 64
+
+
+def _buffer(name, shape, dtype, device):
+    """
+    Scratch tensor reused across calls with the same shape, as in a
+    training loop. Only for tensors that autograd does not save, since
+    the next call overwrites it.
+    """
+    cache = getattr(_buffers, 'cache', None)
+    if cache is None:
+        cache = _buffers.cache = {}
+    key = (name, tuple(shape), dtype, torch.device(device))
+    if key not in cache:
+        if len(cache) >= _BUFFERS_MAX:
+            cache.clear()
+        cache[key] = torch.empty(shape, dtype=dtype, device=device)
+    return cache[key]
+
+
+def _rejection_sample(n, propose, dtype, device):
+    """
+    Draws candidates in blocks sized from the acceptance rate so far,
+    keeps the first accepted one per element with index arithmetic,
+    and redraws only for the elements that are left.
+    :param n: number of elements
+    :param propose: propose(left, n_cand) -> (candidates, accept), both
+        of shape [n_cand, len(left)], for the elements indexed by left
+    :return: accepted candidates, of shape [n]
+    """
+    out = torch.empty(n, dtype=dtype, device=device)
+    left = torch.arange(n, device=device)
+    # one candidate per element first, which also gives the rate
+    n_cand = 1
+    while left.numel() > 0:
+        cand, accept = propose(left, n_cand)
+
+        p_accept = min(max(accept.double().mean().item(),
+                           _REJECTION_P_ACCEPT_MIN),
+                       _REJECTION_P_ACCEPT_MAX)
+        # enough candidates that an element is left over w.p.
+        # _REJECTION_P_LEFT
+        n_cand = int(math.ceil(
+            math.log(_REJECTION_P_LEFT) / math.log1p(-p_accept)))
+        n_cand = min(max(n_cand, 1), _REJECTION_MAX_CAND)
+
+        done = accept.any(0)
+        first = accept.to(torch.uint8).argmax(0)
+        out[left[done]] = cand.gather(0, first[None])[0][done]
+        left = left[~done]
+    return out
 
 
 class VonMisesFisher(torch.distributions.Distribution):
@@ -16,19 +81,31 @@ class VonMisesFisher(torch.distributions.Distribution):
 
     @property
     def mean(self):
-        return self.loc * (ive(self.__m / 2, self.scale) / ive(self.__m / 2 - 1, self.scale))
+        return self.loc * self.__ive_ratio()
 
     @property
     def stddev(self):
         return self.scale
 
-    def __init__(self, loc, scale, validate_args=None):
+    def __init__(self, loc, scale, validate_args=None, lookup_table=False):
+        """
+        :param lookup_table: if True, or a LogIveTable for order
+        loc.shape[-1] / 2 - 1, the log normalizer and the entropy are
+        interpolated from the (cached) table instead of calling ive.
+        """
         self.dtype = loc.dtype
         self.loc = loc
         self.scale = scale
         self.device = loc.device
         self.__m = loc.shape[-1]
-        self.__e1 = (torch.Tensor([1.] + [0] * (loc.shape[-1] - 1))).to(self.device)
+        if lookup_table is True:
+            lookup_table = log_ive_table(self.__m / 2 - 1)
+        elif lookup_table is False:
+            lookup_table = None
+        elif not isinstance(lookup_table, LogIveTable):
+            raise ValueError('Unsupported lookup_table=%s' % lookup_table)
+        self.__table = lookup_table
+        self.__e1 = torch.tensor([1.] + [0.] * (loc.shape[-1] - 1), dtype=self.dtype, device=self.device)
 
         super(VonMisesFisher, self).__init__(self.loc.size(), validate_args=validate_args)
 
@@ -39,34 +116,71 @@ class VonMisesFisher(torch.distributions.Distribution):
     def rsample(self, shape=torch.Size()):
         shape = shape if isinstance(shape, torch.Size) else torch.Size([shape])
 
-        w = self.__sample_w3(shape=shape) if self.__m == 3 else self.__sample_w_rej(shape=shape)
-
-        v = (torch.distributions.Normal(0, 1).sample(
-            shape + torch.Size(self.loc.shape)).to(self.device).transpose(0, -1)[1:]).transpose(0, -1)
+        if self.__m == 2:
+            w = self.__sample_w2(shape=shape)
+        elif self.__m == 3:
+            w = self.__sample_w3(shape=shape)
+        else:
+            w = self.__sample_w_rej(shape=shape)
+
+        # directions orthogonal to e1, drawn directly in m - 1 dims.
+        # float32 noise suffices for a direction (and is ~2x faster to draw
+        # than float64); it is normalized in self.dtype.
+        v = _buffer('v', shape + self.loc.shape[:-1] + (self.__m - 1,),
+                    torch.float32 if self.dtype == torch.float64
+                    else self.dtype, self.device).normal_().to(self.dtype)
         v = v / v.norm(dim=-1, keepdim=True)
 
-        w_ = torch.sqrt(torch.clamp(1 - (w ** 2), 1e-10))
-        x = torch.cat((w, w_ * v), -1)
-        z = self.__householder_rotation(x)
+        # sqrt(1 - w^2) exactly (so that |z| = 1), with the gradient of
+        # sqrt(1 - w^2 + 1e-10), which stays finite at |w| = 1
+        w2_ = torch.clamp((1 - w) * (1 + w), 0)
+        w_eps = torch.sqrt(w2_ + 1e-10)
+        w_ = w_eps - (w_eps - torch.sqrt(w2_)).detach()
+        z = self.__householder_rotation(w, w_ * v)
 
         return z.type(self.dtype)
 
+    def __sample_w2(self, shape):
+        """
+        von Mises, by Best & Fisher (1979): wrapped Cauchy envelope
+        """
+        shape = shape + torch.Size(self.scale.shape)
+        scale = self.scale.expand(shape).reshape(-1)
+        # rho = (tau - sqrt(2 tau)) / (2 scale), without the cancellation
+        tau = 1 + torch.sqrt(1 + 4 * scale ** 2)
+        rho = 2 * scale / (tau + torch.sqrt(2 * tau))
+        r = (1 + rho ** 2) / (2 * rho)
+
+        with torch.no_grad():
+            scale_, r_ = scale.detach(), r.detach()
+
+            def propose(left, n_cand):
+                rl, sl = r_[left], scale_[left]
+                z = torch.cos(math.pi * torch.rand(
+                    n_cand, left.numel(), dtype=r_.dtype, device=self.device))
+                u = torch.rand_like(z)
+                f = (1 + rl * z) / (rl + z)
+                c = sl * (rl - f)
+                accept = (c * (2 - c) > u) | (torch.log(c / u) + 1 - c >= 0)
+                return z, accept
+
+            z = _rejection_sample(scale.numel(), propose, r_.dtype, self.device)
+
+        # w = cos(angle) from the accepted z, differentiable w.r.t. scale
+        self.__w = ((1 + r * z) / (r + z)).reshape(shape)
+        return self.__w
+
     def __sample_w3(self, shape):
         shape = shape + torch.Size(self.scale.shape)
-        u = torch.distributions.Uniform(0, 1).sample(shape).to(self.device)
+        u = _buffer('u', shape, self.scale.dtype, self.device).uniform_()
         self.__w = 1 + torch.stack([torch.log(u), torch.log(1 - u) - 2 * self.scale], dim=0).logsumexp(0) / self.scale
         return self.__w
 
     def __sample_w_rej(self, shape):
         c = torch.sqrt((4 * (self.scale ** 2)) + (self.__m - 1) ** 2)
-        b_true = (-2 * self.scale + c) / (self.__m - 1)
-
-        # using Taylor approximation with a smooth swift from 10 < scale < 11
-        # to avoid numerical errors for large scale
-        b_app = (self.__m - 1) / (4 * self.scale)
-        s = torch.min(torch.max(torch.tensor([0.], device=self.device),
-                                self.scale - 10), torch.tensor([1.], device=self.device))
-        b = b_app * s + b_true * (1 - s)
+        # = (-2 * scale + c) / (m - 1), without the cancellation for large
+        # scale (a Taylor approximation used here before was off for large m)
+        b = (self.__m - 1) / (2 * self.scale + c)
 
         a = (self.__m - 1 + 2 * self.scale + c) / 4
         d = (4 * a * b) / (1 + b) - (self.__m - 1) * math.log(self.__m - 1)
@@ -75,41 +189,48 @@ class VonMisesFisher(torch.distributions.Distribution):
         return self.__w
 
     def __while_loop(self, b, a, d, shape):
-
-        b, a, d = [e.repeat(*shape, *([1] * len(self.scale.shape))) for e in (b, a, d)]
-        w, e, bool_mask = torch.zeros_like(b).to(self.device), torch.zeros_like(
-            b).to(self.device), (torch.ones_like(b) == 1).to(self.device)
-
         shape = shape + torch.Size(self.scale.shape)
+        b, a, d = [v.expand(shape).reshape(-1) for v in (b, a, d)]
+        m1 = self.__m - 1
+        conc = torch.tensor(m1 / 2, dtype=b.dtype, device=self.device)
+        beta = torch.distributions.Beta(conc, conc)
 
-        while bool_mask.sum() != 0:
-            e_ = torch.distributions.Beta((self.__m - 1) / 2, (self.__m - 1) /
-                                          2).sample(shape[:-1]).reshape(shape).to(self.device)
-            u = torch.distributions.Uniform(0, 1).sample(shape).to(self.device)
-
-            w_ = (1 - (1 + b) * e_) / (1 - (1 - b) * e_)
-            t = (2 * a * b) / (1 - (1 - b) * e_)
-
-            accept = ((self.__m - 1) * t.log() - t + d) > torch.log(u)
-            reject = 1 - accept
-
-            w[bool_mask * accept] = w_[bool_mask * accept]
-            e[bool_mask * accept] = e_[bool_mask * accept]
-
-            bool_mask[bool_mask * accept] = reject[bool_mask * accept]
-
-        return e, w
-
-    def __householder_rotation(self, x):
+        with torch.no_grad():
+            b_, a_, d_ = b.detach(), a.detach(), d.detach()
+
+            def propose(left, n_cand):
+                bl, al, dl = b_[left], a_[left], d_[left]
+                e_ = beta.sample((n_cand, left.numel()))
+                u = torch.rand_like(e_)
+                t = (2 * al * bl) / (1 - (1 - bl) * e_)
+                accept = (m1 * t.log() - t + dl) > torch.log(u)
+                return e_, accept
+
+            e = _rejection_sample(b.numel(), propose, b.dtype, self.device)
+
+        # w from the accepted e, so that it is differentiable w.r.t. b
+        w = (1 - (1 + b) * e) / (1 - (1 - b) * e)
+        return e.reshape(shape), w.reshape(shape)
+
+    def __householder_rotation(self, w, wv):
+        """
+        Reflects x = [w, wv] so that e1 maps to loc:
+        x - 2 (x . u) u, with u = (e1 - loc) / |e1 - loc|,
+        without concatenating x first.
+        """
         u = (self.__e1 - self.loc)
-        u = u / (u.norm(dim=-1, keepdim=True) + 1e-5)
-        z = x - 2 * (x * u).sum(-1, keepdim=True) * u
-        return z
+        # exactly unit, so that the reflection is orthogonal; u = 0
+        # (loc = e1) leaves x as is
+        norm = u.norm(dim=-1, keepdim=True)
+        u = u / torch.where(norm > 0, norm, torch.ones_like(norm))
+        xu = w * u[..., :1] + (wv * u[..., 1:]).sum(-1, keepdim=True)
+        return torch.cat((w, wv), -1) - 2 * xu * u
 
     def entropy(self):
-        output = - self.scale * ive(self.__m / 2, self.scale) / ive((self.__m / 2) - 1, self.scale)
+        log_ive, ratio = self.__log_ive_and_ratio()
+        output = - self.scale * ratio + self.__log_normalization(log_ive)
 
-        return output.view(*(output.shape[:-1])) + self._log_normalization()
+        return output.view(*(output.shape[:-1]))
 
     def log_prob(self, x):
         return self._log_unnormalized_prob(x) - self._log_normalization()
@@ -120,12 +241,51 @@ class VonMisesFisher(torch.distributions.Distribution):
         return output.view(*(output.shape[:-1]))
 
     def _log_normalization(self):
-        output = - ((self.__m / 2 - 1) * torch.log(self.scale) - (self.__m / 2) * math.log(2 * math.pi) - (
-            self.scale + torch.log(ive(self.__m / 2 - 1, self.scale))))
+        output = self.__log_normalization(self.__log_ive())
 
         return output.view(*(output.shape[:-1]))
 
+    def __log_normalization(self, log_ive):
+        return - ((self.__m / 2 - 1) * torch.log(self.scale) - (self.__m / 2) * math.log(2 * math.pi) - (
+            self.scale + log_ive))
+
+    def _kl_uniform(self):
+        """
+        KL(self || HypersphericalUniform(m - 1)) in closed form:
+        scale * I_{m/2} / I_{m/2-1} + log C_m(scale) + log |S^{m-1}|,
+        with the constants combined in double precision.
+        """
+        v = self.__m / 2 - 1
+        const = (_log_surface_area(self.__m - 1)
+                 - (self.__m / 2) * math.log(2 * math.pi))
+        log_ive, ratio = self.__log_ive_and_ratio()
+        output = (self.scale * (ratio - 1) - log_ive
+                  + v * torch.log(self.scale) + const)
+
+        return output.view(*(output.shape[:-1]))
+
+    def __log_ive(self):
+        if self.__table is not None:
+            return self.__table(self.scale)
+        # in log space for large orders, where ive underflows at small scale
+        return _log_ive(self.__m / 2 - 1, self.scale)
+
+    def __ive_ratio(self):
+        return self.__log_ive_and_ratio()[1]
+
+    def __log_ive_and_ratio(self):
+        """
+        :return: log ive(m/2 - 1, scale), I_{m/2}(scale) / I_{m/2-1}(scale)
+        """
+        if self.__table is not None:
+            return self.__table(self.scale, return_ratio=True)
+        log_ive, log_ive1 = _log_ive_pair(self.__m / 2 - 1, self.scale)
+        return log_ive, torch.exp(log_ive1 - log_ive)
+
 
 @register_kl(VonMisesFisher, HypersphericalUniform)
 def _kl_vmf_uniform(vmf, hyu):
-    return - vmf.entropy() + hyu.entropy()
+    if hyu.dim != vmf.loc.shape[-1] - 1:
+        raise ValueError('Unsupported hyu.dim=%d for vmf.loc.shape=%s'
+                         % (hyu.dim, tuple(vmf.loc.shape)))
+    return vmf._kl_uniform()
@@ -1 +1,2 @@
-from pylabyk.hyperspherical_vae.ops.ive import ive
+from .ive import ive
+from .log_ive_table import LogIveTable, log_ive_table
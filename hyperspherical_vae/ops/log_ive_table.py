@@ -0,0 +1,107 @@
+
+import math
+import torch
+
+from .ive import _log_ive_pair
+
+
+class LogIveTable(object):
+    """
+    log ive(v, kappa) and its derivative tabulated on a log-spaced kappa
+    grid, interpolated with cubic Hermite splines in log kappa.
+    The spline is a differentiable function of kappa; outside
+    [kappa_min, kappa_max] ive is called instead.
+    The ratio I_{v+1} / I_v, needed for the entropy, is tabulated too.
+    With the defaults, the abs. error in the ratio is < 1e-9, and that in
+    log ive is < 1e-9 for v <= 10, growing about linearly with v
+    (see demo/bench_log_ive_table.py).
+    """
+
+    def __init__(self, v, kappa_min=1e-3, kappa_max=1e4, n_per_decade=128):
+        self.v = float(v)
+        self.kappa_min = float(kappa_min)
+        self.kappa_max = float(kappa_max)
+
+        self.log_kappa_min = math.log(kappa_min)
+        n = int(math.ceil(math.log10(kappa_max / kappa_min) * n_per_decade)) + 1
+        self.dlog_kappa = (math.log(kappa_max) - self.log_kappa_min) / (n - 1)
+        log_kappa = torch.linspace(
+            self.log_kappa_min, math.log(kappa_max), n, dtype=torch.double)
+        kappa = torch.exp(log_kappa)
+
+        log_out, log_out1 = _log_ive_pair(self.v, kappa)
+        ratio = torch.exp(log_out1 - log_out)
+        # values and derivatives w.r.t. log kappa, in units of grid steps.
+        # d log ive / d kappa = R + v / kappa - 1, and
+        # dR / d kappa = 1 - (2v + 1) R / kappa - R^2, where
+        # R = I_{v+1} / I_v.
+        h = self.dlog_kappa
+        self.__g = log_out
+        self.__dg = (kappa * (ratio - 1.) + self.v) * h
+        self.__r = ratio
+        self.__dr = (kappa * (1. - ratio ** 2)
+                     - (2. * self.v + 1.) * ratio) * h
+        self.__tables = {}
+
+    def __tables_like(self, kappa):
+        key = (kappa.dtype, kappa.device)
+        if key not in self.__tables:
+            self.__tables[key] = [
+                v.to(dtype=kappa.dtype, device=kappa.device)
+                for v in (self.__g, self.__dg, self.__r, self.__dr)]
+        return self.__tables[key]
+
+    def __spline(self, kappa, return_ratio):
+        g, dg, r, dr = self.__tables_like(kappa)
+        pos = (torch.log(torch.clamp(kappa, self.kappa_min, self.kappa_max))
+               - self.log_kappa_min) / self.dlog_kappa
+        i = torch.clamp(pos.detach().floor().long(), 0, g.shape[0] - 2)
+        s = pos - i
+        s2 = s ** 2
+        s3 = s2 * s
+        # cubic Hermite basis
+        h = (2 * s3 - 3 * s2 + 1, s3 - 2 * s2 + s, 3 * s2 - 2 * s3, s3 - s2)
+
+        def hermite(y, dy):
+            return (h[0] * y[i] + h[1] * dy[i]
+                    + h[2] * y[i + 1] + h[3] * dy[i + 1])
+
+        if return_ratio:
+            return hermite(g, dg), hermite(r, dr)
+        return hermite(g, dg)
+
+    def __call__(self, kappa, return_ratio=False):
+        """
+        :param kappa: tensor > 0
+        :param return_ratio: if True, also return I_{v+1}(kappa) / I_v(kappa)
+        :return: log ive(v, kappa)[, I_{v+1}(kappa) / I_v(kappa)]
+        """
+        res = self.__spline(kappa, return_ratio)
+        outside = (kappa < self.kappa_min) | (kappa > self.kappa_max)
+        if not outside.any():
+            return res
+        log_out, log_out1 = _log_ive_pair(self.v, kappa[outside])
+        if not return_ratio:
+            res = res.clone()
+            res[outside] = log_out
+            return res
+        out, ratio = res[0].clone(), res[1].clone()
+        out[outside] = log_out
+        ratio[outside] = torch.exp(log_out1 - log_out)
+        return out, ratio
+
+
+_log_ive_tables = {}
+
+
+def log_ive_table(v, kappa_min=1e-3, kappa_max=1e4, n_per_decade=128):
+    """
+    LogIveTable cached by its arguments, so that models sharing the
+    dimension share the table.
+    """
+    key = (float(v), float(kappa_min), float(kappa_max), int(n_per_decade))
+    if key not in _log_ive_tables:
+        _log_ive_tables[key] = LogIveTable(
+            v, kappa_min=kappa_min, kappa_max=kappa_max,
+            n_per_decade=n_per_decade)
+    return _log_ive_tables[key]
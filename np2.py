@@ -240,20 +240,155 @@ def ____BATCH____():
     pass
 
 
-def arrayfun(fun, *args: np.ndarray):
+def _list2array(res: list, shape, dtype=None) -> np.ndarray:
+    """
+    Typed array if all elements of res are scalars (or dtype is given);
+    otherwise an object array whose elements are res's elements.
+    """
+    if dtype is None:
+        try:
+            arr = np.array(res)
+            if arr.shape == (len(res),) and arr.dtype != object:
+                return arr.reshape(shape)
+        except ValueError:  # ragged
+            pass
+        dtype = object
+    if dtype is object:
+        arr = np.empty(len(res), dtype=object)
+        for i, res1 in enumerate(res):
+            arr[i] = res1
+    else:
+        arr = np.array(res, dtype=dtype)
+    return arr.reshape(shape)
+
+
+def _arrayfun_vectorized(fun, args, shape):
+    """
+    Call fun once on the whole arrays, or via torch.vmap for tensors.
+    :return: output of the given shape, or None if neither works.
+    """
+    try:
+        out = fun(*args)
+        if tuple(out.shape) == tuple(shape):
+            return out
+    except Exception:
+        pass
+
+    if any([torch.is_tensor(v) for v in args]):
+        try:
+            args_flatten = [torch.as_tensor(v).flatten() for v in args]
+            out = torch.vmap(fun)(*args_flatten)
+            if tuple(out.shape) == (args_flatten[0].numel(),):
+                return out.reshape(shape)
+        except Exception:
+            pass
+    return None
+
+
+def arrayfun(fun, *args: np.ndarray, vectorized=False, dtype=None):
     """
 
     :param fun:
     :param args: arrays
+    :param vectorized: if True, first try calling fun once on the whole
+    arrays (or via torch.vmap if args are tensors), and fall back to
+    the loop only if that fails or gives an output of a wrong shape.
+    :param dtype: dtype of the output. If None, typed if fun returns
+    scalars; object otherwise.
     :return: res[...] = fun(arrays[0][...], arrays[1][...], ...)
     """
     shape = args[0].shape
+    if vectorized:
+        res = _arrayfun_vectorized(fun, args, shape)
+        if res is not None:
+            if dtype is not None:
+                res = np.asarray(res, dtype=dtype)
+            return res
+
     args_flatten = [v.flatten() for v in args]
     res = [fun(*v) for v in zip(*args_flatten)]
-    return np.array(res, dtype=np.object).reshape(shape)
+    return _list2array(res, shape, dtype)
+
+
+def _meshfun_chunk(fun, list_args_chunk, n_out=1):
+    """Run fun on a chunk of cells; module-level to be picklable"""
+    res = []
+    for args in list_args_chunk:
+        out1 = fun(*args)
+        if n_out == 1:
+            res.append((out1,))
+        else:
+            res.append(tuple(out1))
+    return res
+
+
+def _cache_key(args) -> tuple:
+    """
+    A cell's args as plain Python values (e.g., float rather than
+    np.float64), so that cache keys don't depend on numpy's repr.
+    """
+    key = []
+    for arg in args:
+        if isinstance(arg, np.generic):
+            arg = arg.item()
+        try:
+            hash(arg)
+        except TypeError:
+            arg = '%s' % (arg,)
+        key.append(arg)
+    return tuple(key)
+
+
+def _shape_each(out1) -> tuple:
+    try:
+        return tuple(out1.shape)
+    except AttributeError:
+        if isinstance(out1, dict):
+            return ()
+        try:
+            return (len(out1),)
+        except TypeError:
+            return ()
+
+
+def _meshfun_vectorized(fun, list_args, shape_all, n_out=1, dtype=None):
+    """
+    Call fun once on args reshaped to an open mesh
+    (like np.ix_), so that broadcasting gives the full mesh.
+    :return: tuple of outputs, or None if fun fails or gives
+    outputs that don't broadcast to the mesh.
+    """
+    n_arg = len(list_args)
+    shape_mesh = tuple([len(arg) for arg in list_args])
+    args_mesh = [
+        np.reshape(np.asarray(arg),
+                   [-1 if i_arg == i_dim else 1 for i_dim in range(n_arg)])
+        for i_arg, arg in enumerate(list_args)
+    ]
+    try:
+        outs = fun(*args_mesh)
+    except Exception:
+        return None
+    if n_out == 1:
+        outs = (outs,)
+    elif not isinstance(outs, (tuple, list)) or len(outs) != n_out:
+        return None
+
+    res = []
+    for out1, dtype1 in zip(outs, dtype):
+        if np.ndim(out1) != n_arg:
+            return None
+        try:
+            out1 = np.broadcast_to(out1, shape_mesh)
+        except ValueError:
+            return None
+        res.append(np.array(out1, dtype=dtype1).reshape(shape_all))
+    return tuple(res)
 
 
-def meshfun(fun, list_args, n_out=1, dtype=None, outshape_first=False):
+def meshfun(fun, list_args, n_out=1, dtype=None, outshape_first=False,
+            executor='serial', n_jobs=None, chunksize=None,
+            progress=False, cache_file=None, vectorized=False):
     """
     EXAMPLE:
     out[i,j] = fun(list_args[0][i], list_args[1][j])
@@ -266,6 +401,21 @@ def meshfun(fun, list_args, n_out=1, dtype=None, outshape_first=False):
     @param outshape_first:  If False (default), each output's shape is
     all args' shapes and the individual output's shape, concatenated
     in order. If True, the individual output shape comes first.
+    @param executor: 'serial'|'thread'|'process'. With 'process',
+    fun must be picklable (e.g., defined at the module level).
+    @param n_jobs: number of workers; defaults to os.cpu_count().
+    @param chunksize: number of cells per task. Defaults to splitting
+    the cells into about 4 chunks per worker.
+    @param progress: if True, print the number of cells done after each
+    chunk.
+    @param cache_file: if given, each cell's output is memoized in this
+    file (via cacheutil.CacheDict, keyed by the cell's args as plain
+    Python values), which is saved when the sweep ends, fails, or is
+    interrupted, so that it resumes from the cells not yet computed.
+    @param vectorized: if True, first try calling fun once with the args
+    reshaped to broadcast to the mesh, and fall back to calling it on
+    each cell only if that fails. Only for outputs that are scalars per
+    cell.
     @rtype: np.ndarray
     @return: tuple of outputs, each an np.ndarray.
     shape first.
@@ -281,42 +431,106 @@ def meshfun(fun, list_args, n_out=1, dtype=None, outshape_first=False):
         except:
             shape_all += (len(arg),)
             list_args1 += [arg]
+    if vectorized:
+        out = _meshfun_vectorized(fun, list_args1, shape_all, n_out, dtype)
+        if out is not None:
+            return out
     # shape_all += (n_out,)
-    list_args1 = np.meshgrid(*list_args1, indexing='ij')
+    list_args1 = list(np.meshgrid(*list_args1, indexing='ij'))
     for i in range(len(list_args1)):
         list_args1[i] = list_args1[i].flatten()
-    res = []
-    for args in zip(*list_args1):
-        out1 = fun(*args)
-        if n_out == 1:
-            res.append([out1])
+    cells = list(zip(*list_args1))
+    n_cell = len(cells)
+
+    # out[i_out][i_cell, ...]: allocated when the first output arrives
+    out = [None] * n_out
+
+    def store(i_cell, outs):
+        for i_out, out1 in enumerate(outs):
+            if out[i_out] is None:
+                shape_each = _shape_each(out1)
+                dtype1 = dtype[i_out]
+                if dtype1 is None:
+                    dtype1 = (object if isinstance(out1, dict)
+                              else np.asarray(out1).dtype)
+                out[i_out] = np.empty((n_cell,) + shape_each,
+                                      dtype=dtype1)
+            elif (dtype[i_out] is None and out[i_out].dtype != object):
+                # promote, e.g., from int to float, as np.array() would
+                dtype1 = np.result_type(out[i_out].dtype,
+                                        np.asarray(out1).dtype)
+                if dtype1 != out[i_out].dtype:
+                    out[i_out] = out[i_out].astype(dtype1)
+            out[i_out][i_cell] = out1
+
+    cache = None
+    cached = {}
+    to_compute = []
+    if cache_file is not None:
+        from .cacheutil import CacheDict
+        cache = CacheDict(cache_file, verbose=False)
+        cached = cache.getdict()
+    for i_cell, args in enumerate(cells):
+        key = _cache_key(args)
+        if key in cached:
+            store(i_cell, cached[key])
         else:
-            res.append(list(out1))
+            to_compute.append(i_cell)
+    n_done = n_cell - len(to_compute)
+
+    if executor == 'serial':
+        n_jobs = 1
+    elif n_jobs is None:
+        import os
+        n_jobs = os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(len(to_compute) / (4 * n_jobs))))
+    chunks = [to_compute[st:(st + chunksize)]
+              for st in range(0, len(to_compute), chunksize)]
+
+    def on_chunk_done(chunk, res_chunk):
+        nonlocal n_done
+        for i_cell, outs in zip(chunk, res_chunk):
+            store(i_cell, outs)
+            if cache is not None:
+                cached[_cache_key(cells[i_cell])] = outs
+        n_done += len(chunk)
+        if progress:
+            print('meshfun: %d/%d cells done' % (n_done, n_cell))
+
+    n_cached = n_done
     try:
-        shape_each = res[0].shape[1:]
-    except:
-        shape_each = ()
-    out = []
-    for i_out in range(n_out):
-        res1 = res[0][i_out]
-        try:
-            shape_each = res1.shape
-        except:
-            if isinstance(res1, dict):
-                shape_each = ()
+        if executor == 'serial':
+            for chunk in chunks:
+                on_chunk_done(chunk, _meshfun_chunk(
+                    fun, [cells[i] for i in chunk], n_out))
+        elif executor in ('thread', 'process'):
+            from concurrent import futures
+            if executor == 'thread':
+                pool = futures.ThreadPoolExecutor(n_jobs)
             else:
-                try:
-                    shape_each = (len(res1),)
-                except:
-                    shape_each = ()
-        out.append(
-            np.array(
-                [res1[i_out] for res1 in res],
-                dtype=dtype[i_out]
-            ).reshape(shape_all + shape_each, order='C')
-        )
+                pool = futures.ProcessPoolExecutor(n_jobs)
+            with pool:
+                chunk_of_future = {
+                    pool.submit(_meshfun_chunk,
+                                fun, [cells[i] for i in chunk], n_out): chunk
+                    for chunk in chunks
+                }
+                for future in futures.as_completed(chunk_of_future):
+                    on_chunk_done(chunk_of_future[future], future.result())
+        else:
+            raise ValueError('Unsupported executor=%s' % executor)
+    finally:
+        # Saved once rather than after each chunk, which would rewrite
+        # the whole file every time
+        if cache is not None and n_done > n_cached:
+            cache.save()
+
+    for i_out in range(n_out):
+        shape_each = out[i_out].shape[1:]
+        out[i_out] = out[i_out].reshape(shape_all + shape_each, order='C')
         if outshape_first:
-            out[-1] = p2st(out[-1], len(shape_each))
+            out[i_out] = p2st(out[i_out], len(shape_each))
     return tuple(out)
 
     # out = np.transpose(
@@ -409,19 +623,100 @@ def wstd(values, weights, axis=None):
                           axis=axis)
     return np.sqrt(variance)
 
+def _unique_upto(v: np.ndarray, n_max: int):
+    """
+    Sorted unique values of v if there are at most n_max of them;
+    None otherwise. O(n * n_max) without sorting v.
+    NaN, if any, counts as one of the n_max values but is left out of the
+    output; np.searchsorted() puts it after them.
+    """
+    is_nan = np.isnan(v)
+    if np.any(is_nan):
+        v = v[~is_nan]
+        n_max = n_max - 1
+        if v.size == 0:
+            return np.zeros(0)
+    if np.unique(v[:(n_max + 1) * 100]).size > n_max:
+        return None
+    x = []
+    cur = np.min(v)
+    while True:
+        x.append(cur)
+        if len(x) > n_max:
+            return None
+        rest = v[v > cur]
+        if rest.size == 0:
+            return np.array(x)
+        cur = np.min(rest)
+
+
 def quantilize(v, n_quantile=5, return_summary=False, fallback_to_unique=True):
-    """Quantile starting from 0. Array is flattened first."""
+    """
+    Quantile starting from 0. Array is flattened first.
+    Ties are split across quantiles in the order of appearance
+    (as in ordinal ranks), so that the counts are as equal as possible.
+    Uses partition and searchsorted rather than a full sort.
+    If fallback_to_unique and there are n_quantile or fewer unique
+    values (up to uniquetol's tol), returns the index of the unique value
+    instead.
+    NaNs rank after all other values: they get the last index of the
+    unique values, or are split across the last quantiles.
+    """
 
-    v = np.array(v)
+    v = np.array(v).flatten()
+    n = v.size
+    if n == 0:
+        ix = np.zeros(0, dtype=np.int32)
+        if return_summary:
+            return ix, np.zeros(0, dtype=v.dtype)
+        return ix
 
+    x = None
     if fallback_to_unique:
-        x, ix = uniquetol(v, return_inverse=True)
-    
-    if (not fallback_to_unique) or len(x) > n_quantile:
-        n = v.size
-        ix = np.int32(np.ceil((stats.rankdata(v, method='ordinal') + 0.) \
-                              / n * n_quantile) - 1)
-    
+        tol = 1e-6
+        v_round = np.round(v / tol) * tol
+        x = _unique_upto(v_round, n_quantile)
+
+    if x is not None:
+        ix = np.searchsorted(x, v_round)
+    else:
+        # c[k - 1]: the number of elements in quantiles < k
+        c = (np.arange(1, n_quantile) * n) // n_quantile
+        edges = np.partition(v, c)[c]
+
+        # Each edge itself is the first element of its quantile
+        ix = np.searchsorted(edges, v, side='right')
+
+        # Values tied with an edge: split by their ordinal ranks
+        if edges.size > 0:
+            # NaNs sort last, after the edges, and tie with each other
+            edge_below = edges[np.maximum(ix - 1, 0)]
+            on_edge = np.flatnonzero((ix > 0) & (
+                (v == edge_below) | (np.isnan(v) & np.isnan(edge_below))))
+            edges_unique, n_edge = np.unique(edges, return_counts=True)
+            if on_edge.size > edges_unique.size or np.any(n_edge > 1):
+                # ix[i] = k means edges[k - 1] <= v[i] < edges[k], so
+                # n_below[j], the number of elements < edges_unique[j],
+                # follows from the counts of ix.
+                j_edge = np.searchsorted(edges_unique, edges)
+                n_below = np.cumsum(np.bincount(
+                    np.r_[0, j_edge + 1],
+                    weights=np.bincount(ix, minlength=n_quantile),
+                    minlength=edges_unique.size + 1)).astype(np.int64)
+                j = j_edge[ix[on_edge] - 1]
+                # Ordinal rank among the elements tied with the same edge;
+                # a stable sort of 16-bit integers is a radix sort.
+                order = np.argsort(
+                    j.astype(np.int16) if edges_unique.size < 2 ** 15
+                    else j, kind='stable')
+                j_sorted = j[order]
+                rank_tie = np.empty_like(order)
+                rank_tie[order] = (np.arange(order.size)
+                                   - np.searchsorted(j_sorted, j_sorted))
+                rank0 = n_below[j] + rank_tie
+                ix[on_edge] = np.searchsorted(c, rank0, side='right')
+
+    ix = ix.astype(np.int32)
     if return_summary:
         x = npg.aggregate(ix, v, func='mean')
         return ix, x
@@ -430,29 +725,182 @@ def quantilize(v, n_quantile=5, return_summary=False, fallback_to_unique=True):
     
 def discretize(v, cutoff):
     """
-    Discretize given cutoff.
+    Discretize given cutoff, which should be increasing.
     
     ix[i] = 0 if v[i] < cutoff[0]
     ix[i] = k if cutoff[k - 1] <= v[i] < cutoff[k]
     v[i] = len(cutoff) if v[i] >= cutoff[-1]
+    ix[i] = 0 if v[i] is NaN
     """
     v = np.array(v)
-    ix = np.zeros(v.shape, dtype=np.long)
-    
-    cutoff = list(cutoff)
-    cutoff.append(np.inf)
-    n = len(cutoff)
-    
-    for ii in range(1,n):
-        ix[(v >= cutoff[ii - 1]) & (v < cutoff[ii])] = ii
-    
-    ix[v >= cutoff[-1]] = n - 1    
-    return ix
+    ix = np.asarray(np.searchsorted(np.asarray(cutoff), v, side='right'))
+    ix[np.isnan(v)] = 0
+    return ix.astype(np.int64)
     
 def uniquetol(v, tol=1e-6, return_inverse=False, **kwargs):
     return np.unique(np.round(np.array(v) / tol) * tol, 
                      return_inverse=return_inverse, **kwargs)
 
+class QuantileSketch(object):
+    """
+    Mergeable, approximate quantile sketch (a merging t-digest) for data
+    that arrive in chunks, e.g., one session at a time.
+    Optionally carries sums of auxiliary values (e.g., choices) per
+    centroid, so that quantile-binned summaries like plt2.plot_binned_ch()
+    need only one pass over the chunks.
+
+    EXAMPLE:
+    sketch = QuantileSketch()
+    for x, ch in sessions:
+        sketch.update(x, ch)
+    edges = sketch.edges(n_quantile=5)
+    x, p, sd, n = sketch.binned_summary(n_quantile=5)
+
+    Larger compression gives more centroids and more accurate edges
+    (error in quantile roughly < 1 / compression; smaller at the tails).
+    """
+    def __init__(self, compression=200., n_aux=1):
+        self.compression = compression
+        self.n_aux = n_aux
+        self.n = 0.
+        self.vmin = np.inf
+        self.vmax = -np.inf
+
+        # Centroids, sorted by mean
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.aux_sum = np.zeros((0, n_aux))
+        self.aux_sumsq = np.zeros((0, n_aux))
+
+    def update(self, v, aux=None) -> 'QuantileSketch':
+        """
+        :param v: a chunk of values. Flattened; NaNs are ignored.
+        :param aux: [len(v)] or [len(v), n_aux]: auxiliary values
+        (e.g., choices) to summarize per quantile. Omit if n_aux=0 or
+        to ignore.
+        :return: self
+        """
+        v = np.asarray(v, dtype=float).flatten()
+        if aux is None:
+            aux = np.zeros((v.size, self.n_aux))
+        else:
+            aux = np.asarray(aux, dtype=float).reshape([v.size, -1])
+        incl = ~np.isnan(v)
+        v = v[incl]
+        aux = aux[incl]
+        if v.size == 0:
+            return self
+
+        self.n += v.size
+        self.vmin = min(self.vmin, np.min(v))
+        self.vmax = max(self.vmax, np.max(v))
+        self._compress(
+            np.concatenate([self.means, v]),
+            np.concatenate([self.weights, np.ones(v.size)]),
+            np.concatenate([self.aux_sum, aux], 0),
+            np.concatenate([self.aux_sumsq, aux ** 2], 0),
+        )
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Merge another sketch, e.g., from another worker, into self.
+        :return: self
+        """
+        assert other.n_aux == self.n_aux
+        if other.n == 0:
+            return self
+        self.n += other.n
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        self._compress(
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+            np.concatenate([self.aux_sum, other.aux_sum], 0),
+            np.concatenate([self.aux_sumsq, other.aux_sumsq], 0),
+        )
+        return self
+
+    def _compress(self, means, weights, aux_sum, aux_sumsq):
+        order = np.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+
+        # Merge neighbors within the same unit of the scale function
+        # k(q) = compression / (2 pi) * arcsin(2q - 1),
+        # so that centroids are small near the tails.
+        cw = np.cumsum(weights)
+        q = (cw - weights / 2.) / cw[-1]
+        k = np.floor(self.compression / (2. * np.pi)
+                     * np.arcsin(2. * q - 1.))
+        st = np.flatnonzero(np.concatenate([[True], np.diff(k) != 0]))
+
+        self.weights = np.add.reduceat(weights, st)
+        self.means = np.add.reduceat(means * weights, st) / self.weights
+        self.aux_sum = np.add.reduceat(aux_sum[order], st, axis=0)
+        self.aux_sumsq = np.add.reduceat(aux_sumsq[order], st, axis=0)
+
+    def quantile(self, q) -> np.ndarray:
+        """
+        :param q: between 0 and 1
+        :return: approximate q-th quantile(s)
+        """
+        cw = np.cumsum(self.weights)
+        centers = cw - self.weights / 2.
+        return np.interp(
+            np.asarray(q) * self.n,
+            np.concatenate([[0.], centers, [self.n]]),
+            np.concatenate([[self.vmin], self.means, [self.vmax]])
+        )
+
+    def edges(self, n_quantile=5) -> np.ndarray:
+        """
+        :return: edges[k]: boundary between quantiles k and k + 1,
+        to use with discretize()
+        """
+        return self.quantile(np.arange(1, n_quantile) / n_quantile)
+
+    def quantilize(self, v, n_quantile=5) -> np.ndarray:
+        """
+        Quantile of each value of v (starting from 0), given the edges
+        from the data seen so far.
+        """
+        return discretize(v, self.edges(n_quantile))
+
+    def binned_summary(self, n_quantile=5
+                       ) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                  np.ndarray]:
+        """
+        Summary per quantile. Each centroid's weight is split across
+        quantiles in proportion to the ranks it spans, so the counts are
+        exact; the rest is approximate as the values within a centroid
+        are not kept. Increase compression to reduce the error.
+        :return: x[quantile]: mean of v,
+            mean[quantile, aux], sd[quantile, aux]: mean and SD of aux,
+            n[quantile]: number of values
+        """
+        # Ranks spanned by each centroid and each quantile
+        cw = np.cumsum(self.weights)
+        lb_rank = (cw - self.weights)[:, None]
+        ub_rank = cw[:, None]
+        bounds = np.arange(n_quantile + 1) / n_quantile * self.n
+        lb_quantile = bounds[None, :-1]
+        ub_quantile = bounds[None, 1:]
+
+        # frac[centroid, quantile]
+        frac = np.clip(
+            np.minimum(ub_rank, ub_quantile)
+            - np.maximum(lb_rank, lb_quantile), 0., None
+        ) / self.weights[:, None]
+
+        n = self.weights @ frac
+        x = (self.means * self.weights) @ frac / n
+        mean = frac.T @ self.aux_sum / n[:, None]
+        sd = np.sqrt(np.clip(
+            frac.T @ self.aux_sumsq / n[:, None] - mean ** 2, 0., None))
+        return x, mean, sd, n
+
+
 def ecdf(x0):
     """
     Empirical distribution.
@@ -517,26 +965,143 @@ def nansem(v, axis=None, **kwargs):
     return s / np.sqrt(n)
 
 
-def wpercentile(w: np.ndarray, prct, axis=None):
-    """
+class RunningStat(object):
     """
-    if axis is not None:
-        raise NotImplementedError()
-    cw = np.concatenate([np.zeros(1), np.cumsum(w)])
-    cw /= cw[-1]
-    f = interpolate.interp1d(cw, np.arange(len(cw)) - .5)
-    return f(prct / 100.)
+    Streaming, mergeable mean/var/std/sem (Welford/Chan's algorithm),
+    for data that arrive in chunks, e.g., one session at a time, or are
+    processed by parallel workers. Ignores NaNs; accepts weights.
 
-    # if axis is None:
-    #     axis = 0
-    #     v = v.flatten()
-    #     w = w.flatten()
-    # z = vec_on(np.zeros(v.shape[axis]), axis, v.ndim)
-    # cv = np.cumsum(v, axis)
-    # cv = np.concatenate([z, cv], axis)
-    # cw = np.cumsum(w, axis)
-    # cw = np.concatenate
-    # f = stats.interpolate.interp1d(w, cv)
+    EXAMPLE:
+    stat = RunningStat(axis=0)
+    for v in sessions:
+        stat.update(v)
+    stat.mean, stat.std, stat.sem  # same as nanmean, nanstd, nansem
+
+    stat_w = RunningStat(axis=None).update(v, w)
+    stat_w.std  # same as wstd(v, w)
+    """
+    def __init__(self, axis=0):
+        """
+        :param axis: axis of each chunk to reduce (concatenate) along;
+        None to flatten each chunk.
+        """
+        self.axis = axis
+        self.count = 0  # number of non-NaN values
+        self.n = 0.  # sum of weights
+        self._mean = 0.
+        self.m2 = 0.  # sum of weighted squared deviations from mean
+
+    def update(self, v, w=None) -> 'RunningStat':
+        """
+        :param v: a chunk of values
+        :param w: weights of the same shape as v; None for equal weights.
+        :return: self
+        """
+        v = np.asarray(v, dtype=float)
+        w = np.ones_like(v) if w is None else np.broadcast_to(
+            np.asarray(w, dtype=float), v.shape)
+        axis = self.axis
+        if axis is None:
+            v = v.flatten()
+            w = w.flatten()
+            axis = 0
+        is_nan = np.isnan(v)
+        v = np.where(is_nan, 0., v)
+        w = np.where(is_nan, 0., w)
+
+        n = w.sum(axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (w * v).sum(axis) / n
+        mean = np.where(n > 0, mean, 0.)
+        m2 = (w * (v - np.expand_dims(mean, axis)) ** 2).sum(axis)
+        return self._combine(np.sum(~is_nan, axis), n, mean, m2)
+
+    def merge(self, other: 'RunningStat') -> 'RunningStat':
+        """
+        Merge statistics from another RunningStat, e.g., from a worker.
+        :return: self
+        """
+        return self._combine(other.count, other.n, other._mean, other.m2)
+
+    def _combine(self, count, n, mean, m2) -> 'RunningStat':
+        n_all = self.n + n
+        delta = mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(n_all > 0, n / n_all, 0.)
+        self._mean = self._mean + delta * frac
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * frac
+        self.n = n_all
+        self.count = self.count + count
+        return self
+
+    @property
+    def mean(self):
+        with np.errstate(invalid='ignore'):
+            return np.where(self.n > 0, self._mean, np.nan)
+
+    def var(self, ddof=0):
+        """
+        :param ddof: subtracted from the sum of weights, treating them as
+        frequency weights; with unit weights, it is in units of count,
+        as in np.nanvar.
+        """
+        dof = self.n - ddof
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(dof > 0, self.m2 / np.where(dof > 0, dof, 1.),
+                            np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var())
+
+    @property
+    def sem(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std / np.sqrt(np.asarray(self.count, dtype=float))
+
+
+def wpercentile(w: np.ndarray, prct, axis=None) -> np.ndarray:
+    """
+    Percentile of the index along axis, weighted by w:
+    the fractional index at which the cumulative sum of w reaches prct%,
+    where index i spans from i - .5 to i + .5.
+    Vectorized across the other dims and across prct.
+    :param w: nonnegative weights
+    :param prct: scalar or array of percentiles between 0 and 100.
+    :param axis: if None, w is flattened.
+    :return: res[prct..., rest...]: prct's dims first,
+    followed by w's dims except axis (as in np.percentile).
+    """
+    w = np.asarray(w, dtype=float)
+    if axis is None:
+        w = w.flatten()
+        axis = 0
+    w = np.moveaxis(w, axis, -1)
+    shape_rest = w.shape[:-1]
+    n = w.shape[-1]
+    w = w.reshape([-1, n])
+    n_batch = w.shape[0]
+
+    cw = np.concatenate([np.zeros([n_batch, 1]), np.cumsum(w, -1)], -1)
+    cw /= cw[:, [-1]]
+
+    p = np.asarray(prct, dtype=float) / 100.
+    shape_prct = p.shape
+    p = p.reshape([1, -1])
+
+    # Batched searchsorted: offset each row (within [0, 1]) by 2 * row
+    offset = 2. * np.arange(n_batch)[:, None]
+    j = np.searchsorted(
+        (cw + offset).flatten(), (p + offset).flatten(), side='left'
+    ).reshape([n_batch, -1]) - (n + 1) * np.arange(n_batch)[:, None]
+    j = j.clip(1, n)
+
+    # Linear interpolation between cw[j - 1] and cw[j]
+    c0 = np.take_along_axis(cw, j - 1, -1)
+    dc = np.take_along_axis(cw, j, -1) - c0
+    frac = np.where(dc > 0, (p - c0) / np.where(dc > 0, dc, 1.), 0.)
+    res = j - 1.5 + frac
+    return res.T.reshape(shape_prct + shape_rest)
 
 
 def wmedian(w, axis=None):
@@ -572,6 +1137,79 @@ def pearsonr_ci(x,y,alpha=0.05):
     return r, p, lo, hi
 
 
+def pearsonr_ci_matrix(x: np.ndarray, y: np.ndarray = None, alpha=0.05,
+                       dtype=np.float64, chunksize=None
+                       ) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                  np.ndarray]:
+    """
+    Vectorized pearsonr_ci() for all pairs of columns of x (and y),
+    using pairwise-complete observations when there are NaNs.
+    :param x: [observation, variable_x]
+    :param y: [observation, variable_y]; if None, use x.
+    :param alpha: significance level.
+    :param dtype: e.g., np.float32 to save memory and time.
+    :param chunksize: number of columns of x to process at a time,
+    to bound the memory for intermediate arrays; None to do all at once.
+    :return: r, pval, lo, hi: each [variable_x, variable_y]
+    """
+    x = np.asarray(x, dtype=dtype)
+    y = x if y is None else np.asarray(y, dtype=dtype)
+    if x.ndim == 1:
+        x = x[:, None]
+    if y.ndim == 1:
+        y = y[:, None]
+
+    # Centering first reduces cancellation in the sums below
+    x = x - np.nanmean(x, 0, keepdims=True)
+    y = y - np.nanmean(y, 0, keepdims=True)
+    is_valid_y = ~np.isnan(y)
+    has_nan = not (is_valid_y.all() and not np.isnan(x).any())
+    y0 = np.where(is_valid_y, y, 0.).astype(dtype)
+    m_y = is_valid_y.astype(dtype)
+
+    n_x = x.shape[1]
+    if chunksize is None:
+        chunksize = n_x
+    r = np.empty((n_x, y.shape[1]), dtype=dtype)
+    n = np.empty((n_x, y.shape[1]), dtype=dtype)
+    for st in range(0, n_x, chunksize):
+        x1 = x[:, st:(st + chunksize)]
+        if has_nan:
+            is_valid_x = ~np.isnan(x1)
+            x0 = np.where(is_valid_x, x1, 0.).astype(dtype)
+            m_x = is_valid_x.astype(dtype)
+
+            n1 = m_x.T @ m_y
+            sx = x0.T @ m_y
+            sy = m_x.T @ y0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cov = x0.T @ y0 - sx * sy / n1
+                var_x = (x0 ** 2).T @ m_y - sx ** 2 / n1
+                var_y = m_x.T @ (y0 ** 2) - sy ** 2 / n1
+        else:
+            n1 = np.full((x1.shape[1], y.shape[1]), x.shape[0],
+                         dtype=dtype)
+            cov = x1.T @ y0
+            var_x = np.sum(x1 ** 2, 0)[:, None]
+            var_y = np.sum(y0 ** 2, 0)[None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r[st:(st + chunksize)] = np.clip(
+                cov / np.sqrt(var_x * var_y), -1., 1.)
+        n[st:(st + chunksize)] = n1
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt((n - 2) / (1. - r ** 2))
+        pval = 2. * stats.t.sf(np.abs(t), n - 2)
+        pval = np.where(np.abs(r) == 1., 0., pval)
+
+        r_z = np.arctanh(r)
+        se = 1. / np.sqrt(n - 3)
+    z = stats.norm.ppf(1. - alpha / 2.)
+    lo = np.tanh(r_z - z * se)
+    hi = np.tanh(r_z + z * se)
+    return r, pval.astype(dtype), lo, hi
+
+
 def info_criterion(nll, n_trial, n_param, kind='BIC'):
     """
 
@@ -758,11 +1396,18 @@ def nansmooth(u, sigma=1.):
     return r
 
 
-def convolve_time(src, kernel, dim_time=0, mode='same'):
+def convolve_time(src, kernel, dim_time=0, mode='same', algo='auto'):
     """
+    Causal convolution along dim_time, with the start of the kernel
+    anchored to the start of src.
     @type src: np.ndarray
     @type kernel: np.ndarray
     @type dim_time: int
+    @param mode: 'same': same length as src; 'full': full convolution.
+    @param algo: 'auto'|'direct'|'fft'|'oa' (overlap-add). 'auto' picks
+    one from the lengths of src and kernel, using
+    numpytorch.conv_algo(). 'fft' and 'oa' require a kernel that varies
+    only along dim_time; otherwise 'direct' is used.
     @rtype: np.ndarray
     """
     if kernel.ndim == 1 and kernel.ndim < dim_time + 1:
@@ -770,28 +1415,42 @@ def convolve_time(src, kernel, dim_time=0, mode='same'):
     if kernel.ndim < src.ndim:
         kernel = np.expand_dims(
             kernel,
-            np.arange(kernel.ndim, src.ndim)
+            tuple(np.arange(kernel.ndim, src.ndim))
         )
     if np.mod(kernel.shape[dim_time], 2) != 1:
-        pad_width = np.zeros((kernel.ndim, 2), dtype=np.long)
+        pad_width = np.zeros((kernel.ndim, 2), dtype=np.int64)
         pad_width[dim_time, 1] = 1
         kernel = np.pad(kernel, pad_width, mode='constant')
 
     len_kernel_half = (kernel.shape[dim_time] - 1) // 2
-    pad_width = np.zeros((src.ndim, 2), dtype=np.long)
-    pad_width[dim_time, :] = len_kernel_half
-    src = np.pad(src, pad_width, mode='constant')
+    if mode not in ('same', 'full'):
+        raise ValueError('Unsupported mode=%s' % mode)
 
-    from scipy import ndimage
-    dst = ndimage.convolve(src, kernel, mode='constant')
+    if kernel.size != kernel.shape[dim_time]:
+        algo = 'direct'
+    elif algo == 'auto':
+        algo = numpytorch.conv_algo(src.shape[dim_time],
+                                    kernel.shape[dim_time])
+
+    if algo == 'direct':
+        pad_width = np.zeros((src.ndim, 2), dtype=np.int64)
+        pad_width[dim_time, :] = len_kernel_half
+        src = np.pad(src, pad_width, mode='constant')
+
+        from scipy import ndimage
+        dst = ndimage.convolve(src, kernel, mode='constant')
+    elif algo in ('fft', 'oa'):
+        from scipy import signal
+        if algo == 'fft':
+            dst = signal.fftconvolve(src, kernel, axes=dim_time)
+        else:
+            dst = signal.oaconvolve(src, kernel, axes=dim_time)
+    else:
+        raise ValueError('Unsupported algo=%s' % algo)
     dst = np.moveaxis(dst, dim_time, 0)
 
     if mode == 'same':
-        dst = dst[:-(len_kernel_half * 2)]
-    elif mode == 'full':
-        pass
-    else:
-        raise ValueError('Unsupported mode=%s' % mode)
+        dst = dst[:(dst.shape[0] - len_kernel_half * 2)]
     dst = np.moveaxis(dst, 0, dim_time)
     return dst
 
@@ -11,9 +11,17 @@ from typing import Union, Iterable, Tuple, Dict, Sequence
 from torch.distributions import MultivariateNormal, Uniform, Normal, \
     Categorical, OneHotCategorical
 
+from . import stat2
+
+import numbers
+import threading
+
 device0 = torch.device('cpu')  # CHECKING
 # device0 = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
+# Per-thread device and dtype set by compute_context
+_context = threading.local()
+
 
 #%% Wrapper that allows numpy-style syntax for torch
 def ____NUMPY_COMPATIBILITY____():
@@ -95,8 +103,57 @@ def ____TYPE____():
     pass
 
 
+def get_device(default=None) -> torch.device:
+    """
+    :return: device of the innermost compute_context in this thread;
+    default (or device0 if default is None) outside of it.
+    """
+    device = getattr(_context, 'device', None)
+    if device is not None:
+        return device
+    return device0 if default is None else default
+
+
+def get_dtype() -> torch.dtype:
+    """
+    :return: floating-point dtype of the innermost compute_context in
+    this thread; torch.get_default_dtype() outside of it.
+    """
+    dtype = getattr(_context, 'dtype', None)
+    return torch.get_default_dtype() if dtype is None else dtype
+
+
+class compute_context(object):
+    """
+    Sets the device and/or floating-point dtype used by the constructors
+    in numpytorch (tensor, zeros, ones, eye, arange, linspace, ...) and
+    yktorch (enforce_float_tensor), within this thread only.
+    Contexts can be nested; None keeps the outer context's value.
+
+    EXAMPLE:
+    with compute_context(device='cuda', dtype=torch.float32):
+        p = lognorm_pmf(linspace(0., 2., 100)[:, None], ...)
+    """
+    def __init__(self, device=None, dtype=None):
+        self.device = None if device is None else torch.device(device)
+        self.dtype = dtype
+
+    def __enter__(self):
+        self._prev = (getattr(_context, 'device', None),
+                      getattr(_context, 'dtype', None))
+        if self.device is not None:
+            _context.device = self.device
+        if self.dtype is not None:
+            _context.dtype = self.dtype
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _context.device, _context.dtype = self._prev
+        return False
+
+
 def float(v):
-    return v.type(torch.get_default_dtype())
+    return v.type(get_dtype())
 
 
 def tensor(v: Union[float, np.ndarray, torch.Tensor],
@@ -107,6 +164,8 @@ def tensor(v: Union[float, np.ndarray, torch.Tensor],
     Construct a tensor if the input is not; otherwise return the input as is,
     but return None as is for convenience when input is not passed.
     Same as enforce_tensor
+    Within compute_context(dtype=...), floating-point inputs that are
+    not tensors become that dtype unless dtype is given.
     :param v:
     :param min_ndim:
     :param device:
@@ -114,13 +173,16 @@ def tensor(v: Union[float, np.ndarray, torch.Tensor],
     :return:
     """
     if device is None:
-        device = device0
+        device = get_device()
 
     if v is None:
         pass
     else:
         if not torch.is_tensor(v):
             v = torch.tensor(v, device=device, **kwargs)
+            if ('dtype' not in kwargs and torch.is_floating_point(v)
+                    and getattr(_context, 'dtype', None) is not None):
+                v = v.to(_context.dtype)
         if v.ndimension() < min_ndim:
             v = v.expand(v.shape
                          + torch.Size([1] * (min_ndim - v.ndimension())))
@@ -139,44 +201,54 @@ def cuda(v):
         v.cuda()
 
 
+def _kw_context(kwargs, floating=True):
+    """device and dtype from compute_context, unless given in kwargs"""
+    kw = {'device': get_device()}
+    if floating:
+        kw['dtype'] = get_dtype()
+    kw.update(kwargs)
+    return kw
+
+
 def zeros(*args, **kwargs):
-    return torch.zeros(*args, **{'device': device0, **kwargs})
+    return torch.zeros(*args, **_kw_context(kwargs))
 
 
 def ones(*args, **kwargs):
-    return torch.ones(*args, **{'device': device0, **kwargs})
+    return torch.ones(*args, **_kw_context(kwargs))
 
 
 def zeros_like(*args, **kwargs):
-    return torch.zeros_like(*args, **{'device': device0, **kwargs})
+    return torch.zeros_like(*args, **_kw_context(kwargs, floating=False))
 
 
 def ones_like(*args, **kwargs):
-    return torch.ones_like(*args, **{'device': device0, **kwargs})
+    return torch.ones_like(*args, **_kw_context(kwargs, floating=False))
 
 
 def eye(*args, **kwargs):
-    return torch.eye(*args, **{'device': device0, **kwargs})
+    return torch.eye(*args, **_kw_context(kwargs))
 
 
 def empty(*args, **kwargs):
-    return torch.empty(*args, **{'device': device0, **kwargs})
+    return torch.empty(*args, **_kw_context(kwargs))
 
 
 def empty_like(*args, **kwargs):
-    return torch.empty_like(*args, **{'device': device0, **kwargs})
+    return torch.empty_like(*args, **_kw_context(kwargs, floating=False))
 
 
 def arange(*args, **kwargs):
-    return torch.arange(*args, **{'device': device0, **kwargs})
+    # Integer arguments give a LongTensor, as in torch.arange
+    floating = any([
+        (isinstance(v, numbers.Real) and not isinstance(v, numbers.Integral))
+        or (torch.is_tensor(v) and torch.is_floating_point(v))
+        for v in args])
+    return torch.arange(*args, **_kw_context(kwargs, floating=floating))
 
 
 def linspace(*args, **kwargs):
-    return torch.linspace(*args, **{'device': device0, **kwargs})
-
-
-def float(v):
-    return v.type(torch.get_default_dtype())
+    return torch.linspace(*args, **_kw_context(kwargs))
 
 
 def numpy(v: Union[torch.Tensor, np.ndarray, Iterable]):
@@ -236,6 +308,97 @@ def nan2v(v, fill=0.):
     return v
 
 
+# Checked by check_anomaly(); see anomaly_mode
+_anomaly_enabled = False
+_anomaly_raise = False
+_anomaly_report = []
+
+
+def set_anomaly_mode(enabled=True, raise_error=False):
+    """
+    Turn on/off checking for NaNs in distribution kernels
+    (inv_gaussian_cdf, inv_gaussian_pmf_mean_stdev, lognorm_pmf, ...).
+    When off (default), check_anomaly() returns immediately, so the
+    kernels don't sync or reduce.
+    :param raise_error: if True, raise FloatingPointError at the first
+    anomaly, after recording it.
+    """
+    global _anomaly_enabled, _anomaly_raise
+    _anomaly_enabled = enabled
+    _anomaly_raise = raise_error
+
+
+def get_anomaly_report() -> list:
+    """
+    :return: list of dicts with keys:
+    'name': where the anomaly was found,
+    'n_nan': number of NaNs, 'n': number of elements,
+    'params': dict of parameter values at the NaN elements.
+    """
+    return _anomaly_report
+
+
+def clear_anomaly_report():
+    del _anomaly_report[:]
+
+
+class anomaly_mode(object):
+    """
+    Context manager that checks for NaNs in distribution kernels.
+
+    EXAMPLE:
+    with anomaly_mode() as report:
+        p = inv_gaussian_pmf_mean_stdev(x, mu, std)
+    for rec in report:
+        print(rec['name'], rec['params']['mu'])
+    """
+    def __init__(self, raise_error=False):
+        self.raise_error = raise_error
+        self.report = []
+
+    def __enter__(self):
+        global _anomaly_report
+        self._prev = (_anomaly_enabled, _anomaly_raise, _anomaly_report)
+        _anomaly_report = self.report
+        set_anomaly_mode(True, self.raise_error)
+        return self.report
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _anomaly_report
+        enabled, raise_error, _anomaly_report = self._prev
+        set_anomaly_mode(enabled, raise_error)
+        return False
+
+
+def check_anomaly(name: str, v: torch.Tensor, **params) -> None:
+    """
+    If anomaly mode is on, record NaNs in v along with the values of
+    params (broadcast against v) at those elements. No-op otherwise.
+    """
+    if not _anomaly_enabled:
+        return
+    is_nan = torch.isnan(v.detach())
+    n_nan = int(is_nan.sum())
+    if n_nan == 0:
+        return
+
+    params_nan = {}
+    for k, p in params.items():
+        p = torch.as_tensor(p).detach()
+        try:
+            params_nan[k] = torch.broadcast_to(
+                p.to(v.device), v.shape)[is_nan].cpu()
+        except RuntimeError:
+            params_nan[k] = p.cpu()
+    _anomaly_report.append({
+        'name': name, 'n_nan': n_nan, 'n': v.numel(),
+        'params': params_nan,
+    })
+    if _anomaly_raise:
+        raise FloatingPointError('%d NaN(s) out of %d in %s' % (
+            n_nan, v.numel(), name))
+
+
 def nansum(v, *args, inplace=False, **kwargs):
     if not inplace:
         v = v.clone()
@@ -314,28 +477,20 @@ def repeat_all(*args, shape=None, use_expand=False):
     :param shape: desired shape of the output. Give None to match max shape
     of each dim. Give -1 at dims where the max shape is desired.
     """
-    ndim = args[0].ndimension()
-    max_shape = torch.ones(ndim, dtype=torch.long)
-    for arg in args:
-        max_shape, _ = torch.max(torch.cat([
-            tensor(arg.shape)[None, :], max_shape[None, :]],
-            dim=0), dim=0)
+    shape_max = max_shape([arg.shape for arg in args])
     if shape is None:
-        shape = max_shape
+        shape = shape_max
     else:
-        shape = tensor(shape)
-        is_free = shape == -1
-        shape[is_free] = max_shape[is_free]
+        shape = torch.Size([s1 if s == -1 else int(s)
+                            for s, s1 in zip(shape, shape_max)])
 
     out = []
     for arg in args:
         if use_expand:
-            out.append(arg.expand(
-                *tuple(shape)))
-                # *tuple((shape / tensor(arg.shape)).long())))
+            out.append(arg.expand(shape))
         else:
-            out.append(arg.repeat(
-                *tuple((shape / tensor(arg.shape)).long())))
+            out.append(arg.repeat([
+                s // max(s0, 1) for s, s0 in zip(shape, arg.shape)]))
 
     return tuple(out)
 
@@ -358,13 +513,16 @@ def repeat_to_shape(arg, shape):
     """
     return repeat_all(arg, shape=shape)[0]
 
-def max_shape(shapes):
-    return torch.Size(
-        torch.max(
-            torch.stack([tensor(v) for v in shapes]),
-            dim=0
-        )[0]
-    )
+def max_shape(shapes) -> torch.Size:
+    """
+    Max of each dim across shapes of the same length,
+    without allocating tensors.
+    """
+    shapes = [tuple(s) for s in shapes]
+    if len({len(s) for s in shapes}) > 1:
+        raise ValueError('Unsupported shapes of different lengths: %s'
+                         % shapes)
+    return torch.Size([max(s) for s in zip(*shapes)])
 
 def repeat_dim(tensor, repeat, dim):
     """
@@ -372,9 +530,9 @@ def repeat_dim(tensor, repeat, dim):
     :type repeat: int
     :type dim: int
     """
-    rep = torch.ones(tensor.dim(), dtype=torch.long)
-    rep[dim] = tensor(repeat)
-    return tensor.repeat(torch.Size(rep))
+    rep = [1] * tensor.dim()
+    rep[dim] = int(repeat)
+    return tensor.repeat(rep)
 
 def repeat_batch(*args,
                  repeat_existing_dims=False, to_append_dims=False,
@@ -455,22 +613,17 @@ def expand_upto_dim(args, dim, to_expand_left=True):
             # Nothing to expand - return
             return tuple(args)
 
-        max_shape = torch.zeros(ndim_expand, dtype=torch.long)
-        for o1 in out1:
-            max_shape, _ = torch.max(torch.cat([
-                max_shape[None,:],
-                tensor(o1.shape[:dim])[None,:]
-            ], dim=0), dim=0)
+        shape_max = max_shape([o1.shape[:ndim_expand] for o1 in out1])
         out2 = []
-        ndim_kept = len(out1[0].shape[dim:])
         for o1 in out1:
-            out2.append(o1.repeat([
-                int(a) for a in torch.cat([
-                    max_shape / tensor(o1.shape[:dim],
-                                              dtype=torch.long),
-                    torch.ones(ndim_kept, dtype=torch.long)
-                ], 0)
-            ]))
+            shape0 = o1.shape[:ndim_expand]
+            if all([s0 == s or s0 == 1 for s0, s in zip(shape0, shape_max)]):
+                # zero-copy when broadcasting suffices
+                out2.append(o1.expand(shape_max + o1.shape[ndim_expand:]))
+            else:
+                out2.append(o1.repeat(
+                    [s // max(s0, 1) for s0, s in zip(shape0, shape_max)]
+                    + [1] * (o1.dim() - ndim_expand)))
     else:
         raise NotImplementedError(
             'to_expand_left=False not implemented/tested yet!')
@@ -542,9 +695,15 @@ def unravel_index(v, shape, **kwargs):
 def ravel_multi_index(v: Iterable[torch.LongTensor],
                       shape: Iterable[int], **kwargs) -> torch.LongTensor:
     """
-    For now, just use np.ravel_multi_index()
+    Same as np.ravel_multi_index() with order='C', staying on the device.
+    Uses np.ravel_multi_index() if kwargs (e.g., mode, order) are given.
     """
-    return longtensor(np.ravel_multi_index(v, shape, **kwargs))
+    if len(kwargs) > 0:
+        return longtensor(np.ravel_multi_index(npys(*v), shape, **kwargs))
+    ix = 0
+    for sub, siz in zip(v, shape):
+        ix = ix * int(siz) + tensor(sub).long()
+    return ix
 
 
 def discretize(a, vmin, vmax=None, nv=None) -> torch.LongTensor:
@@ -568,6 +727,35 @@ def discretize(a, vmin, vmax=None, nv=None) -> torch.LongTensor:
     ).long().clamp(0, nv - 1)  # noqa
 
 
+def discretize_cutoff(v: torch.Tensor, cutoff: torch.Tensor
+                      ) -> torch.LongTensor:
+    """
+    Same as np2.discretize(), using torch.bucketize.
+    ix[i] = k if cutoff[k - 1] <= v[i] < cutoff[k]; 0 if v[i] is NaN.
+    :param v: float-valued tensor
+    :param cutoff: increasing vector
+    :return: index between 0 and len(cutoff) inclusive.
+    """
+    v = tensor(v)
+    cutoff = tensor(cutoff, dtype=v.dtype, device=v.device)
+    ix = torch.bucketize(v, cutoff, right=True)
+    return torch.where(torch.isnan(v), torch.zeros_like(ix), ix)
+
+
+def quantilize(v: torch.Tensor, n_quantile=5) -> torch.LongTensor:
+    """
+    Same as np2.quantilize(..., fallback_to_unique=False), on the device.
+    Flattens v; ties are split across quantiles in the order of appearance.
+    :return: ix[i]: quantile of v.flatten()[i], starting from 0.
+    """
+    v = tensor(v).flatten()
+    n = v.numel()
+    order = torch.sort(v, stable=True)[1]
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(1, n + 1, device=v.device)
+    return (rank * n_quantile + n - 1) // n - 1
+
+
 def ____Algebra____():
     pass
 
@@ -594,6 +782,23 @@ def sumto1(v, dim=None, axis=None, keepdim=True):
 def ____AGGREGATE____():
     pass
 
+def _subs2tensor(subs) -> torch.LongTensor:
+    """
+    :param subs: [dim, element] tensor or array, or a list of vectors
+    :return: [dim, element] LongTensor
+    """
+    if type(subs) is tuple or type(subs) is list:
+        device = next((sub.device for sub in subs if torch.is_tensor(sub)),
+                      get_device())
+        subs = torch.stack([tensor(sub, device=device).long().flatten()
+                            for sub in subs])
+    else:
+        subs = tensor(subs).long()
+        if subs.ndim == 1:
+            subs = subs[None, :]
+    return subs
+
+
 def scatter_add(subs, val, dim=0, shape=None):
     """
     @param subs: ndim x n indices, suitable for np.ravel_multi_index
@@ -602,39 +807,110 @@ def scatter_add(subs, val, dim=0, shape=None):
     @type val: torch.Tensor
     @return:
     """
+    subs = _subs2tensor(subs)
     if shape is None:
-        shape = [(np.amax(sub) + 1) for sub in subs]
-    idx = torch.LongTensor(np.ravel_multi_index(subs, shape))
-    return torch.zeros(np.prod(shape).astype(np.long)).scatter_add(
+        shape = [int(sub.max()) + 1 for sub in subs]
+    idx = ravel_multi_index(subs, shape)
+    return torch.zeros(int(np.prod(shape)), dtype=val.dtype,
+                       device=val.device).scatter_add(
         dim=dim, index=idx, src=val
     ).reshape(shape)
 
-def aggregate(subs, val=1., *args, **kwargs):
+
+aggregate_funcs_torch = ('sum', 'mean', 'max', 'min', 'count', 'len')
+
+
+def aggregate(subs, val=1., func='sum', size=None, fill_value=None,
+              *args, **kwargs):
     """
+    Similar to npg.aggregate(), but computed with torch (index_add,
+    scatter_reduce) for func in aggregate_funcs_torch, so that the output
+    stays on the device and supports autograd.
+    Other funcs or extra arguments fall back to npg.aggregate.
     :param subs: [dim, element]
     :type subs: torch.LongTensor, (*torch.LongTensor)
-    :type size: torch.LongTensor
-    """
+    :param val: scalar or [element]
+    :param func: 'sum'|'mean'|'max'|'min'|'count'|'len' or any func
+    for npg.aggregate
+    :param size: output shape; defaults to max(subs) + 1 on each dim.
+    :param fill_value: value for groups without elements. As in
+    npg.aggregate, defaults to NaN for 'mean', and for 'max' and 'min'
+    with floating-point val; 0 otherwise. Integer outputs are promoted
+    to floating point if fill_value is NaN.
+    :return: tensor of shape size
+    """
+    if (
+        not isinstance(func, str) or func not in aggregate_funcs_torch
+        or len(args) > 0 or len(kwargs) > 0
+    ):
+        if type(subs) is tuple or type(subs) is list:
+            subs = np.stack(npys(*subs))
+            # subs = np.concatenate(npys(*(sub.reshape(1,-1) for sub in subs)), 0)
+        elif torch.is_tensor(subs):
+            subs = npy(subs)
+        if fill_value is not None or len(args) > 0:
+            args = (fill_value,) + args
+        return tensor(npg.aggregate(subs, npy(val), func, size,
+                                    *args, **kwargs))
+
+    subs = _subs2tensor(subs)
+    if size is None:
+        size = [int(sub.max()) + 1 for sub in subs]
+    elif not isinstance(size, Iterable):
+        size = [size]
+    size = [int(s) for s in size]
+    n_out = int(np.prod(size))
+    idx = ravel_multi_index(subs, size)
+
+    n_elem = idx.numel()
+    if not torch.is_tensor(val):
+        val = torch.full((n_elem,), val, device=idx.device,
+                         dtype=(torch.long
+                                if isinstance(val, (int, np.integer))
+                                else get_dtype()))
+    else:
+        val = val.flatten().expand(n_elem)
 
-    if type(subs) is tuple or type(subs) is list:
-        subs = np.stack(subs)
-        # subs = np.concatenate(npys(*(sub.reshape(1,-1) for sub in subs)), 0)
-    elif torch.is_tensor(subs):
-        subs = npy(subs)
-    return tensor(npg.aggregate(subs, val, *args, **kwargs))
-
-    # if size is None:
-    #     size = torch.max(subs, 1)
-    # elif not torch.is_tensor(size):
-    #     size = tensor(size)
-    # #%%
-    # cumsize = torch.cumprod(torch.cat((tensor([1]), size.flip(0)),
-    #                                   0)).flip(0)
-    # #%%
-    # ind = subs * cumsize[:,None]
-    #
-    # raise NotImplementedError(
-    #     'Not finished implementation! Use npg.aggregate meanwhile!')
+    if fill_value is None:
+        if func == 'mean' or (
+                func in ('max', 'min') and torch.is_floating_point(val)):
+            fill_value = np.nan
+        else:
+            fill_value = 0
+    elif (func in ('max', 'min') and np.isnan(fill_value)
+          and not torch.is_floating_point(val)):
+        # An integer output can't hold NaN
+        val = val.to(get_dtype())
+
+    if func in ('max', 'min'):
+        # Groups without elements keep fill_value
+        out = torch.full((n_out,), fill_value, dtype=val.dtype,
+                         device=val.device).scatter_reduce(
+            0, idx, val, reduce='a' + func, include_self=False)
+        return out.reshape(size)
+
+    count = None
+    if func in ('count', 'len', 'mean') or fill_value != 0:
+        count = torch.zeros(n_out, dtype=torch.long, device=idx.device
+                            ).index_add(0, idx, torch.ones_like(idx))
+    if func in ('count', 'len'):
+        out = count
+    else:
+        out = torch.zeros(n_out, dtype=val.dtype, device=val.device
+                          ).index_add(0, idx, val)
+        if func == 'mean':
+            if not torch.is_floating_point(out):
+                out = out.to(get_dtype())
+            out = out / count.clamp_min(1)
+
+    if count is not None:
+        is_empty = count == 0
+        if torch.any(is_empty):
+            if np.isnan(fill_value) and not torch.is_floating_point(out):
+                out = out.to(get_dtype())
+            out = torch.where(is_empty,
+                              torch.full_like(out, fill_value), out)
+    return out.reshape(size)
 
 #%% Stats
 def ____STATS____():
@@ -654,9 +930,92 @@ def logistic(x: torch.Tensor) -> torch.Tensor:
     return p
 
 
-def conv_t(p, kernel, **kwargs):
+def conv_algo(n_t: int, n_kernel: int) -> str:
+    """
+    Choose an algorithm for 1D convolution from the lengths of the signal
+    and the kernel, as in conv_t() and np2.convolve_time().
+    Crossovers are from demo/bench_conv.py on CPU.
+    :return: 'direct'|'fft'|'oa'
+    """
+    if n_kernel <= 16:
+        return 'direct'
+    elif n_kernel * 16 <= n_t:
+        return 'oa'
+    else:
+        return 'fft'
+
+
+def _conv_fft_freq(pf: torch.Tensor, kf: torch.Tensor, groups=1
+                   ) -> torch.Tensor:
+    """
+    Multiply in the frequency domain, summing over input channels
+    within each group as in F.conv1d.
+    :param pf: [batch, channel_in, ..., freq]
+    :param kf: [channel_out, channel_in // groups, freq]
+    :return: [batch, channel_out, ..., freq]
+    """
+    n_batch, n_in = pf.shape[:2]
+    shape_rest = pf.shape[2:]
+    n_out = kf.shape[0]
+    pf = pf.reshape((n_batch, groups, n_in // groups) + shape_rest)
+    kf = kf.reshape([groups, n_out // groups, n_in // groups]
+                    + [1] * (len(shape_rest) - 1) + [kf.shape[-1]])
+    return (pf.unsqueeze(2) * kf.unsqueeze(0)).sum(3).reshape(
+        (n_batch, n_out) + shape_rest)
+
+
+def _conv_full_fft(p: torch.Tensor, kernel: torch.Tensor, groups=1
+                   ) -> torch.Tensor:
+    """
+    Full convolution via FFT.
+    :param p: [batch, channel_in, time]
+    :param kernel: [channel_out, channel_in // groups, time_kernel]
+    :return: [batch, channel_out, time + time_kernel - 1]
+    """
+    n_full = p.shape[-1] + kernel.shape[-1] - 1
+    n_fft = 2 ** int(np.ceil(np.log2(n_full)))
+    pf = torch.fft.rfft(p, n=n_fft)
+    kf = torch.fft.rfft(kernel, n=n_fft)
+    return torch.fft.irfft(_conv_fft_freq(pf, kf, groups),
+                           n=n_fft)[..., :n_full]
+
+
+def _conv_full_oa(p: torch.Tensor, kernel: torch.Tensor, groups=1
+                  ) -> torch.Tensor:
+    """
+    Full convolution via overlap-add, for kernels much shorter than p.
+    :param p: [batch, channel_in, time]
+    :param kernel: [channel_out, channel_in // groups, time_kernel]
+    :return: [batch, channel_out, time + time_kernel - 1]
+    """
+    nt = p.shape[-1]
+    nk = kernel.shape[-1]
+    n_full = nt + nk - 1
+
+    # Blocks of len_block >= nk - 1, so each block's tail spills over
+    # only to the next block
+    len_block = 2 ** int(np.ceil(np.log2(nk)))
+    n_fft = 2 * len_block
+    n_block = -(-nt // len_block)
+    p = F.pad(p, [0, n_block * len_block - nt])
+    p = p.reshape(p.shape[:2] + (n_block, len_block))
+
+    pf = torch.fft.rfft(p, n=n_fft)
+    kf = torch.fft.rfft(kernel, n=n_fft)
+    y = torch.fft.irfft(_conv_fft_freq(pf, kf, groups), n=n_fft)
+
+    # head[..., block, :] + tail[..., block - 1, :]
+    head = F.pad(y[..., :len_block], [0, 0, 0, 1])
+    tail = F.pad(y[..., len_block:], [0, 0, 1, 0])
+    y = (head + tail).reshape(y.shape[:2] + (-1,))
+    return y[..., :n_full]
+
+
+def conv_t(p, kernel, algo='auto', **kwargs):
     """
     1D convolution with the starting time of the signal and kernel anchored.
+    Note that the output is delayed by one time step:
+    out[..., t] = sum_s kernel[..., s] * p[..., t - 1 - s]
 
     EXAMPLE:
     p_cond_rt = npt.conv_t(
@@ -666,106 +1025,165 @@ def conv_t(p, kernel, **kwargs):
     )
     :param p: [batch, time] or [batch, channel_in, time]
     :param kernel: [time] or [channel_out, channel_in, time]
+    :param algo: 'auto'|'direct'|'fft'|'oa' (overlap-add).
+    'auto' uses conv_algo(). Only 'direct' supports kwargs other than
+    groups. All support autograd.
     :param kwargs: fed to F.conv1d
     :return: p[batch, time] or [batch, channel_out, time]
     """
     nt = p.shape[-1]
+    ndim0 = p.ndim
     if p.ndim == 1:
         p = p[None, None, :]
     elif p.ndim == 2:  # [batch, time]
         p = p[:, None, :]
     else:
         assert p.ndim == 3
-
     if kernel.ndim == 1:
-        return F.conv1d(
-            p,
-            kernel.flip(-1)[None, None, :],
-            padding=kernel.shape[-1],
-            **kwargs
-        ).squeeze(0).squeeze(0)[:nt]
-    else:
-        return F.conv1d(
+        kernel = kernel[None, None, :]
+
+    if algo == 'auto':
+        if set(kwargs.keys()) - {'groups'}:
+            algo = 'direct'
+        else:
+            algo = conv_algo(nt, kernel.shape[-1])
+
+    if algo == 'direct':
+        out = F.conv1d(
             p,
             kernel.flip(-1),
             padding=kernel.shape[-1],
             **kwargs
-        )[:, :, :nt].squeeze(0)
-
-
-def shiftdim(v: torch.Tensor, shift: torch.Tensor, dim=0, pad='repeat'):
-    if torch.is_floating_point(shift):
-        lb = shift.floor().long()
-        ub = lb + 1
-        p = tensor(1.) - torch.cat([shift.reshape([1]) - lb,
-                                          ub - shift.reshape([1])], 0)
-        return (
-                shiftdim(v, shift=lb, dim=dim) * p[0]
-                + shiftdim(v, shift=ub, dim=dim) * p[1]
-        )
-
-    if dim != 0:
-        v = v.transpose(0, dim)
-
-    if shift == 0:
-        pass
+        )[:, :, :nt]
+    elif algo in ('fft', 'oa'):
+        fun = _conv_full_fft if algo == 'fft' else _conv_full_oa
+        out = F.pad(fun(p, kernel, **kwargs)[..., :(nt - 1)], [1, 0])
     else:
-        if shift > 0:
-            if pad == 'repeat':
-                vpad = v[0].expand((shift,) + v.shape[1:])
-            else:
-                vpad = torch.zeros((shift,) + v.shape[1:])
+        raise ValueError('Unsupported algo=%s' % algo)
 
-            v = torch.cat([
-                vpad,
-                v[:-shift],
-            ])
-        else:
-            if pad == 'repeat':
-                vpad = v[-1].expand((-shift,) + v.shape[1:])
-            else:
-                vpad = torch.zeros((-shift,) + v.shape[1:])
+    if ndim0 == 1:
+        return out[0, 0]
+    elif ndim0 == 2 and out.shape[1] == 1:
+        return out[:, 0]
+    else:
+        return out.squeeze(0)
 
-            v = torch.cat([
-                v[-shift:],
-                vpad,
-            ])
 
-    if dim != 0:
-        v = v.transpose(0, dim)
-    return v
+def _interp_last(v: torch.Tensor, q: torch.Tensor, pad='repeat'
+                 ) -> torch.Tensor:
+    """
+    Linear interpolation of v at fractional indices q along the last dim
+    with a single gather. Leading dims of v and q are broadcast.
+    :param v: [..., n]
+    :param q: [..., m]; FloatTensor for gradient w.r.t. q
+    :param pad: 'repeat': indices outside [0, n - 1] take the edge value;
+        'zero': they give 0.
+    :return: [..., m]
+    """
+    n = v.shape[-1]
+    batch_shape = torch.broadcast_shapes(v.shape[:-1], q.shape[:-1])
+    v = v.expand(batch_shape + v.shape[-1:])
+    q = q.expand(batch_shape + q.shape[-1:])
+
+    if torch.is_floating_point(q):
+        i0 = q.detach().floor()
+        w = q - i0
+        i0 = i0.long()
+        ix = torch.stack([i0, i0 + 1])
+    else:
+        w = None
+        ix = q.long()[None]
+    vs = v[None].expand((ix.shape[0],) + v.shape).gather(
+        -1, ix.clamp(0, n - 1))
+    if pad == 'zero':
+        vs = torch.where((ix >= 0) & (ix < n), vs, torch.zeros_like(vs))
+    elif pad != 'repeat':
+        raise ValueError('Unsupported pad=%s' % pad)
+    if w is None:
+        return vs[0]
+    return vs[0] + (vs[1] - vs[0]) * w
+
+
+def _shift_fft(v: torch.Tensor, shift: torch.Tensor) -> torch.Tensor:
+    """
+    Shift v[..., n] by shift[...] along the last dim with a phase ramp
+    (band-limited interpolation). Zero-pads enough to avoid wrapping.
+    """
+    n = v.shape[-1]
+    n_pad = n + int(np.ceil(shift.detach().abs().max().item())) + 1
+    freq = torch.fft.rfftfreq(n_pad, device=v.device).to(
+        v.dtype if torch.is_floating_point(v) else get_dtype())
+    phase = torch.exp(-2j * np.pi * freq * shift[..., None])
+    return torch.fft.irfft(torch.fft.rfft(v, n_pad) * phase, n_pad)[..., :n]
+
+
+def shiftdim(v: torch.Tensor, shift: Union[torch.Tensor, float, int],
+             dim=0, pad='repeat', method='linear') -> torch.Tensor:
+    """
+    res[i] = v[i - shift] along dim.
+    :param v: tensor
+    :param shift: scalar, or a tensor broadcastable to v.shape without
+        dim, to shift each batch element differently. Fractional shifts
+        interpolate; give a FloatTensor for gradient w.r.t. shift.
+    :param pad: 'repeat' (edge value) or 'zero'
+    :param method: 'linear' (interpolation with a single gather) or
+        'fft' (phase shift; requires pad='zero')
+    :return: tensor of the same shape as v
+    """
+    shift = torch.as_tensor(shift, device=v.device)
+    if torch.is_floating_point(shift) and torch.is_floating_point(v):
+        shift = shift.to(v.dtype)
+    v = v.movedim(dim, -1)
+    n = v.shape[-1]
+    if method == 'linear':
+        q = torch.arange(n, device=v.device) - shift[..., None]
+        res = _interp_last(v, q, pad=pad)
+    elif method == 'fft':
+        if pad != 'zero':
+            raise ValueError("method='fft' supports pad='zero' only")
+        res = _shift_fft(v, shift)
+    else:
+        raise ValueError('Unsupported method=%s' % method)
+    return res.movedim(-1, dim)
 
 
-def interp1d(query: torch.Tensor, value: torch.Tensor, dim=0) -> torch.Tensor:
+def interp1d(query: Union[torch.Tensor, float, int], value: torch.Tensor,
+             dim=0, batched=False, pad='repeat') -> torch.Tensor:
     """
+    Linear interpolation along dim, with a single gather.
 
     :param query: index on dim. Should be a FloatTensor for gradient.
-    :param value:
+    :param value: tensor
     :param dim:
+    :param batched: if False, res = value[query] (when dim=0), i.e.,
+        query's dims replace dim, as in torch.index_select().
+        If True, query gives the indices for each batch element, as in
+        torch.take_along_dim(): query.shape broadcasts with value.shape
+        except at dim, where it gives the number of queries.
+    :param pad: 'repeat' (clamp queries to the edges) or 'zero'.
+        With 'repeat', integer queries index as in value[query]:
+        negative ones count from the end, and those outside
+        [-n, n - 1] raise IndexError.
     :return: interpolated to give value[query] (when dim=0)
     """
-    v = value
-    if dim != 0:
-        v = v.transpose(0, dim)
-    else:
-        v = v
-
-    if torch.is_floating_point(query):
-        q0 = query.floor().long()
-        q1 = q0 + 1
-        p = query - q0
-        v = (
-            interp1d(q0, v, 0) * (tensor(1.) - p.expand_as(v))
-            + interp1d(q1, v, 0) * p.expand_as(v)
-        )
-    else:
-        v = v[query]
-
-    if dim != 0:
-        v = v.transpose(0, dim)
-    else:
-        v = v
-    return v
+    query = torch.as_tensor(query, device=value.device)
+    if torch.is_floating_point(query) and torch.is_floating_point(value):
+        query = query.to(value.dtype)
+    elif not torch.is_floating_point(query) and pad == 'repeat':
+        n = value.shape[dim]
+        if query.numel() > 0 and (
+                int(query.min()) < -n or int(query.max()) >= n):
+            raise IndexError('query out of range for size %d along dim %d'
+                             % (n, dim))
+        query = query % n
+    v = value.movedim(dim, -1)
+    if batched:
+        res = _interp_last(v, query.movedim(dim, -1), pad=pad)
+        return res.movedim(-1, dim)
+
+    dim = dim % value.dim()
+    res = _interp_last(v, query.reshape([-1]), pad=pad).movedim(-1, dim)
+    return res.reshape(res.shape[:dim] + query.shape + res.shape[dim + 1:])
 
 
 def mean_distrib(p, v, axis=None):
@@ -800,99 +1218,138 @@ def sem_distrib(p, v, axis=None, n=None):
         return np.sqrt(v / n)
 
 
-def min_distrib(p:torch.Tensor
+def wpercentile(w: torch.Tensor, prct, dim=None) -> torch.Tensor:
+    """
+    Same as np2.wpercentile(): percentile of the index along dim,
+    weighted by w. Differentiable with respect to w.
+    :param w: nonnegative weights
+    :param prct: scalar or tensor of percentiles between 0 and 100.
+    :param dim: if None, w is flattened.
+    :return: res[prct..., rest...]: prct's dims first,
+    followed by w's dims except dim.
+    """
+    if dim is None:
+        w = w.flatten()
+        dim = 0
+    w = w.movedim(dim, -1)
+    shape_rest = w.shape[:-1]
+    n = w.shape[-1]
+
+    cw = F.pad(w.cumsum(-1), [1, 0])
+    cw = cw / cw[..., -1:]
+
+    p = torch.as_tensor(prct, dtype=w.dtype, device=w.device) / 100.
+    shape_prct = p.shape
+    p = p.reshape([-1]).expand(shape_rest + p.reshape([-1]).shape)
+
+    j = torch.searchsorted(cw.detach().contiguous(), p.contiguous(),
+                           right=False).clamp(1, n)
+    c0 = cw.gather(-1, j - 1)
+    dc = cw.gather(-1, j) - c0
+    is_pos = dc > 0
+    frac = torch.where(is_pos, (p - c0) / torch.where(is_pos, dc,
+                                                      torch.ones_like(dc)),
+                       torch.zeros_like(dc))
+    res = j - 1.5 + frac
+    return res.movedim(-1, 0).reshape(shape_prct + shape_rest)
+
+
+def wmedian(w: torch.Tensor, dim=None) -> torch.Tensor:
+    return wpercentile(w, prct=50., dim=dim)
+
+
+def min_distrib(p: torch.Tensor, is_log=False, return_log=False
                 ) -> (torch.Tensor, torch.Tensor):
     """
-    Distribution of the min of independent RVs R0 ~ p[0] and R1 ~ p[1].
-    When ndims(p) > 2, each pair of p[0, r0, :] and p[1, r1, :] is processed
+    Distribution of the min of independent RVs R_k ~ p[k], k = 0..N-1.
+    When ndims(p) > 2, each set of p[:, :, batch...] is processed
     separately. p.sum(1) is taken as the number of trials.
 
     p_min, p_1st = min_distrib(p)
 
-    p_min(t,1,:): Probability distribution of min(t_1 ~ p(:,1), t_2 ~ p(:,2))
-    p_1st(t,k,:): Probability of t_k happening first at t.
-                  sums(p_1st, [1, 2]) gives all 1's.
+    p_min(t,:): Probability distribution of min_k(t_k ~ p(k,:))
+    p_1st(k,t,:): Probability of t_k happening first at t.
+                  Ties are split evenly among the RVs that tie.
+                  p_1st.sum(0) gives p_min.
 
-    Formula from: http://math.stackexchange.com/questions/308230/expectation-of-the-min-of-two-independent-random-variables
+    With S_j(t) = P(t_j > t), the probability that t_k is first at t is
+    p_k(t) * E[1 / (1 + #ties)]
+    = p_k(t) * int_0^1 prod_{j != k} (S_j(t) + x p_j(t)) dx,
+    which is evaluated exactly with Gauss-Legendre quadrature,
+    in log space throughout so that tiny probabilities don't underflow.
 
     :param p: [id, value, [batch, ...]]
+    :param is_log: if True, p is given as log (unnormalized) probabilities
+    :param return_log: if True, return log p_min and log p_1st
     :return: p_min[value, batch, ...], p_1st[id, value, batch, ...]
     """
-    assert p.shape[0] == 2
-
     shape0 = p.shape
+    n_id = shape0[0]
     p = p.reshape([shape0[0], shape0[1], -1])
-    p0 = p.clone()
-
-    # p[id, value, batch] = P(value | id, batch)
-    p = sumto1(p, 1)
-
-    # c[id, value, batch] = P(v <= value | id, batch)
-    c = p.cumsum(1)
-
-    # P(T <= either 0 or 1) = P(T <= 0 or 1) - P(T <= 0 and 1)
-    # c_min[1, value, batch]
-    c_min = c.sum(0, keepdim=True) - c.prod(0, keepdim=True)
-
-    # P(T == either 0 or 1) = diff P(T <= either 0 or 1)
-    # p_min[1, value, batch]
-    p_min = F.pad(c_min, [0, 0, 1, 0])
-    p_min = (p_min[:, 1:] - p_min[:, :-1]).clamp_min(0)
-
-    # p_1st[id, value, batch] = P(v == v_min == v_id < v_other | batch)
-    # = P(v_min == v | batch) * P(v_id == v,  v_min = v | batch)
-    p_1st = p_min * nan2v(sumto1(p0, 0))
-
-    # if indep == 'indep':
-    #     # p_both[batch]
-    #     p_both = sum_p[0] * sum_p[1]
-    #
-    #     # p_min[id, value, batch]
-    #     p_min = nan2v(sumto1(p_min, 0).clone()) * sum_p
-    # elif indep == 'disjoint':
-    #     raise NotImplementedError()
-    # else:
-    #     raise ValueError()
-
-    # Special case 1: No p_1st if neither p(:,1) nor p(:,2)
-    any_p = (p != 0).any(0, keepdim=True)
-    p_1st = p_1st * any_p
-
-    # Special case 2: zeros across all values in either id
-    # ch0[id, batch]
-    ch0 = (p == 0).all(1).any(0)
-    # ch00[batch]
-    ch00 = ch0.any(0)
-    p_min[0, :, ch00] = 0
-    p_1st[:, :, ch00] = 0
-
-    # # Keep the total count the product of the two sums
-    # sum_p[]
-    sum_p = p0.sum(1, keepdim=True).prod(0, keepdim=True)
-    p_min = nan2v(sumto1(p_min, [0, 1])) * sum_p
-    p_1st = nan2v(sumto1(p_1st, [0, 1])) * sum_p
-
-    return p_min[0].reshape(shape0[1:]), p_1st.reshape(shape0)
-
-
-def max_distrib(p: torch.Tensor) -> (torch.Tensor, torch.Tensor):
-    """
-    Distribution of the max of independent RVs R0 ~ p[0] and R1 ~ p[1].
-    When ndims(p) > 2, each pair of p[0, r0, :] and p[1, r1, :] is processed
+
+    # log_floor stands in for log(0) to keep gradients finite. Up to
+    # n_id + 1 of them are summed below, so scale it to avoid -inf.
+    log_floor = torch.finfo(p.dtype).min / (4. * (n_id + 1))
+    if is_log:
+        lp = p.clamp_min(log_floor)
+    else:
+        lp = torch.where(p > 0,
+                         torch.log(p.clamp_min(torch.finfo(p.dtype).tiny)),
+                         torch.full_like(p, log_floor))
+    # The number of trials (product of the sums across ids)
+    log_mass = torch.logsumexp(lp, 1).sum(0)
+
+    # lp[id, value, batch] = log P(value | id, batch)
+    lp = lp - torch.logsumexp(lp, 1, keepdim=True)
+
+    # ls[id, value, batch] = log P(v > value | id, batch)
+    ls = torch.logcumsumexp(lp.flip(1), 1).flip(1)
+    ls = torch.cat([ls[:, 1:], torch.full_like(ls[:, :1], log_floor)], 1)
+
+    # The integrand is a polynomial in x of degree n_id - 1
+    x, w = np.polynomial.legendre.leggauss(max(1, (n_id + 1) // 2))
+    x = torch.tensor((x + 1.) / 2., dtype=p.dtype, device=p.device)
+    log_w = torch.tensor(np.log(w / 2.), dtype=p.dtype, device=p.device)
+
+    # term[id, value, batch, x] = log(S_id + x p_id)
+    term = torch.logaddexp(ls[..., None], lp[..., None] + torch.log(x))
+
+    # Sum over j != k from cumulative sums from either end,
+    # which avoids subtracting each id's own term
+    zero = torch.zeros_like(term[:1])
+    excl = (torch.cat([zero, term[:-1].cumsum(0)], 0)
+            + torch.cat([term[1:].flip(0).cumsum(0).flip(0), zero], 0))
+
+    lp_1st = lp + torch.logsumexp(excl + log_w, -1) + log_mass
+    lp_min = torch.logsumexp(lp_1st, 0)
+
+    lp_min = lp_min.reshape(shape0[1:])
+    lp_1st = lp_1st.reshape(shape0)
+    if return_log:
+        return lp_min, lp_1st
+    return lp_min.exp(), lp_1st.exp()
+
+
+def max_distrib(p: torch.Tensor, is_log=False, return_log=False
+                ) -> (torch.Tensor, torch.Tensor):
+    """
+    Distribution of the max of independent RVs R_k ~ p[k], k = 0..N-1.
+    When ndims(p) > 2, each set of p[:, :, batch...] is processed
     separately. p.sum(1) is taken as the number of trials.
 
-    p_max, p_1st = min_distrib(p)
+    p_max, p_last = max_distrib(p)
 
-    p_max(t,1,:): Probability distribution of min(t_1 ~ p(:,1), t_2 ~ p(:,2))
-    p_last(t,k,:): Probability of t_k happening first at t.
-                  sums(p_1st, [1, 2]) gives all 1's.
+    p_max(t,:): Probability distribution of max_k(t_k ~ p(k,:))
+    p_last(k,t,:): Probability of t_k happening last at t.
+                  p_last.sum(0) gives p_max.
 
-    Formula from: http://math.stackexchange.com/questions/308230/expectation-of-the-min-of-two-independent-random-variables
+    See min_distrib() for the arguments.
 
     :param p: [id, value, [batch, ...]]
     :return: p_max[value, batch, ...], p_last[id, value, batch, ...]
     """
-    p_min, p_1st = min_distrib(p.flip(1))
+    p_min, p_1st = min_distrib(p.flip(1), is_log=is_log,
+                               return_log=return_log)
     return p_min.flip(0), p_1st.flip(1)
 
 
@@ -1004,8 +1461,7 @@ def brownian_bridge(n_step, sample_shape=()) -> torch.Tensor:
 
 
 def lognormal_params2mean_stdev(loc, scale):
-    return torch.exp(loc + scale ** 2 / 2.), \
-           (torch.exp(scale ** 2) - 1.) * torch.exp(2 * loc + scale ** 2)
+    return stat2.lognorm2ms(loc, scale)
 
 
 def inv_gaussian_pdf(x, mu, lam):
@@ -1016,28 +1472,28 @@ def inv_gaussian_pdf(x, mu, lam):
     @param lam: lambda in Wikipedia's notation
     @return: p(x; mu, lam)
     """
-    p = torch.sqrt(
-        lam / (2 * pi * x ** 3)
-    ) * torch.exp(-lam * (x - mu) ** 2 / (2 * mu ** 2 * x))
+    p = torch.exp(
+        .5 * (torch.log(lam / x ** 3) - np.log(2 * np.pi))
+        - lam * (x - mu) ** 2 / (2 * mu ** 2 * x)
+    )
+    check_anomaly('inv_gaussian_pdf', p, x=x, mu=mu, lam=lam)
     return p
 
 
 def inv_gaussian_cdf(x, mu, lam):
-    c0 = torch.distributions.Normal(loc=0., scale=1.).cdf(
-        torch.sqrt(lam / x) * (x / mu - 1.)
-    )
-    c1 = torch.distributions.Normal(loc=0., scale=1.).cdf(
-        -torch.sqrt(lam / x) * (x / mu + 1.)
-    )
-
-    if torch.any(torch.isnan(c0)):
-        print('--')  # CHECKING
-    if torch.any(torch.isnan(c1)):
-        print('--')  # CHECKING
-
-    c = c0 + torch.exp(2. * lam / mu) * c1
-    if torch.any(torch.isnan(c)):
-        print('--')  # CHECKING
+    """
+    As in https://en.wikipedia.org/wiki/Inverse_Gaussian_distribution
+    The second term, exp(2 lam / mu) * Phi(-...), is computed in log space
+    so that it doesn't become inf * 0 for large lam / mu.
+    @param x: values to query. Must be positive.
+    @param mu: the expectation
+    @param lam: lambda in Wikipedia's notation
+    @return: P(X <= x; mu, lam)
+    """
+    s = torch.sqrt(lam / x)
+    c = torch.special.ndtr(s * (x / mu - 1.)) + torch.exp(
+        2. * lam / mu + torch.special.log_ndtr(-s * (x / mu + 1.)))
+    check_anomaly('inv_gaussian_cdf', c, x=x, mu=mu, lam=lam)
     return c
 
 
@@ -1060,108 +1516,144 @@ def inv_gaussian_mean_std2params(mu, std):
     return mu, inv_gaussian_variance2lam(mu, std ** 2)
 
 
+class PmfGrid(object):
+    """
+    Terms of a grid x that don't depend on the distribution's parameters.
+    Made (and cached) by pmf_grid() so that PMF kernels evaluated
+    repeatedly on the same x, e.g., during fitting, compute them once.
+    x is along dim 0; x_ext appends x[-1] + dx as the upper edge of the
+    last bin. Nonpositive x are replaced with 1 in x_pos, log_x, and
+    sqrt_x, and masked out with is_pos via torch.where().
+    x itself is not kept, so that the cache in pmf_grid() doesn't keep it
+    alive; x_ext[:-1] has its values.
+    """
+    def __init__(self, x: torch.Tensor, dx=None):
+        if dx is None:
+            dx = x[[1]] - x[[0]]
+        self.dx = dx
+        self.x_ext = torch.cat([x, x[[-1]] + dx], dim=0)
+        self.is_pos = self.x_ext > 0
+        self.x_pos = torch.where(self.is_pos, self.x_ext,
+                                 torch.ones_like(self.x_ext))
+        self.log_x = torch.log(self.x_pos)
+        self.sqrt_x = torch.sqrt(self.x_pos)
+
+
+_pmf_grid_cache = {}
+
+
+def pmf_grid(x: Union[torch.Tensor, PmfGrid], dx=None) -> PmfGrid:
+    """
+    PmfGrid of x, reused while x is alive and not modified in place.
+    Entries are dropped once x is garbage collected. x that requires grad
+    is not cached, since the autograd graph of the grid would keep it alive.
+    :param x: tensor, or a PmfGrid, which is returned as is.
+    """
+    if isinstance(x, PmfGrid):
+        return x
+    if x.requires_grad:
+        return PmfGrid(x, dx)
+    import weakref
+    key = (id(x), None if dx is None else npy(dx).tolist())
+    ref, version, grid = _pmf_grid_cache.get(key, (None, None, None))
+    if ref is not None and ref() is x and version == x._version:
+        return grid
+    for k in [k for k, v in _pmf_grid_cache.items() if v[0]() is None]:
+        _pmf_grid_cache.pop(k)
+    grid = PmfGrid(x, dx)
+    _pmf_grid_cache[key] = (weakref.ref(x), x._version, grid)
+    return grid
+
+
+# Stands in for -inf standard scores so that gradients stay finite
+_z_floor = -1e10
+
+
+def _ndtr_diff(z: torch.Tensor) -> torch.Tensor:
+    """
+    Phi(z[k + 1]) - Phi(z[k]) along dim 0, taken from the upper tail,
+    as Phi(-z[k]) - Phi(-z[k + 1]), where both z are positive, so that it
+    stays accurate when Phi(z) is near 1.
+    """
+    flip = (z[:-1] > 0) & (z[1:] > 0)
+    # erfc keeps relative precision in the lower tail, unlike
+    # torch.special.ndtr
+    c_lower = .5 * torch.special.erfc(-z / np.sqrt(2.))
+    c_upper = .5 * torch.special.erfc(z / np.sqrt(2.))
+    return torch.where(flip, c_upper[:-1] - c_upper[1:],
+                       c_lower[1:] - c_lower[:-1])
+
+
 def inv_gaussian_pmf_mean_stdev(
-        x: torch.Tensor, mu: torch.Tensor, std: torch.Tensor, dx=None,
-        algo='diff_cdf'
+        x: Union[torch.Tensor, PmfGrid], mu: torch.Tensor,
+        std: torch.Tensor, dx=None, algo='diff_cdf'
 ) -> torch.Tensor:
     """
 
-    :param x: must be a 1-dim tensor along dim.
+    :param x: must be a 1-dim tensor along dim, or pmf_grid(x, dx),
+        whose terms are reused across calls.
     :param mu:
     :param std:
     :param dx:
-    :return:
-    """
-    if dx is None:
-        dx = x[[1]] - x[[0]]
-
-    # --- Most robust against NaN; least valid
-    if algo == 'dx':
-        x, mu, std = expand_all(x, mu, std)
-        p = torch.zeros_like(x)
-        incl = x > 0
-        p[incl] = inv_gaussian_pdf(
-            x[incl], mu[incl],
-            inv_gaussian_variance2lam(mu[incl], std[incl] ** 2)
+    :param algo: 'diff_cdf': p[k] = P(x[k] < X < x[k + 1]);
+        'dx': pdf(x[k]) * dx; 'norm_w_cdf': pdf(x[k]) / cdf(x[-1] + dx)
+    :return: p[k]; zero where x[k] <= 0
+    """
+    grid = pmf_grid(x, dx)
+    lam = inv_gaussian_variance2lam(mu, std ** 2)
+    if algo in ('dx', 'norm_w_cdf'):
+        x_pos = grid.x_pos[:-1]
+        log_p = (
+            .5 * (torch.log(lam) - 3. * grid.log_x[:-1] - np.log(2 * np.pi))
+            - lam * (x_pos - mu) ** 2 / (2 * mu ** 2 * x_pos)
         )
-        p[incl] = p[incl] * dx
+        p = torch.where(grid.is_pos[:-1], torch.exp(log_p),
+                        torch.zeros_like(log_p))
+        if algo == 'dx':
+            p = p * grid.dx
+        else:
+            p = p / inv_gaussian_cdf(grid.x_ext[[-1]], mu, lam)
 
     elif algo == 'diff_cdf':
-        # --- Least robust against NaN; most valid
-        x = torch.cat([x, x[[-1]] + dx], dim=0)
-        x, mu, std = expand_all(x, mu, std)
-        c = torch.zeros_like(x)
-        incl = x > 0
-        c[incl] = inv_gaussian_cdf(
-            x[incl], mu[incl],
-            inv_gaussian_variance2lam(mu[incl], std[incl] ** 2)
-        )
-
-        is_nan = torch.isnan(c)
-        if torch.any(is_nan):
-            t = ((x - mu) / std)
-            print(t[is_nan])
-            print(t[~is_nan])
-            print('--')
-
-        p = c[1:] - c[:-1]
-
-    elif algo == 'norm_w_cdf':
-        x, mu, std = expand_all(x, mu, std)
-        p = torch.zeros_like(x)
-        incl = x > 0
-        p[incl] = inv_gaussian_pdf(
-            x[incl], mu[incl],
-            inv_gaussian_variance2lam(mu[incl], std[incl] ** 2)
-        )
-        c = inv_gaussian_cdf(
-            x[[-1]] + dx, mu,
-            inv_gaussian_variance2lam(mu, std ** 2)
-        )
-        p[incl] = p[incl] / c[incl]
+        # P(X <= x) = Phi(a(x)) + exp(2 lam / mu) Phi(b(x)).
+        # The second term is computed in log space to avoid inf * 0.
+        s = torch.sqrt(lam) / grid.sqrt_x
+        a = torch.where(grid.is_pos, s * (grid.x_pos / mu - 1.),
+                        torch.full_like(s, _z_floor))
+        b = torch.where(grid.is_pos, -s * (grid.x_pos / mu + 1.),
+                        torch.full_like(s, _z_floor))
+        c2 = torch.exp(2. * lam / mu + torch.special.log_ndtr(b))
+        p = _ndtr_diff(a) + (c2[1:] - c2[:-1])
 
     else:
-        raise ValueError()
+        raise ValueError('Unsupported algo=%s' % algo)
 
-    # p[torch.isnan(p)] = 0.
-    is_nan = torch.isnan(p)
-    if torch.any(is_nan):
-        print('--')
+    check_anomaly('inv_gaussian_pmf_mean_stdev', p, x=grid.x_ext[:-1], mu=mu,
+                  std=std)
     return p
 
 
 def lognorm_params_given_mean_stdev(mean: torch.Tensor, stdev: torch.Tensor
                                     ) -> (torch.Tensor, torch.Tensor):
-    sigma = torch.sqrt(torch.log(1 + (stdev / mean) ** 2))
-    mu = torch.log(mean) - sigma ** 2 / 2.
-    return mu, sigma
+    return stat2.ms2lognorm(mean, stdev)
 
 
-def lognorm_pmf(x: torch.Tensor, mean: torch.Tensor, stdev: torch.Tensor,
-                ) -> torch.Tensor:
+def lognorm_pmf(x: Union[torch.Tensor, PmfGrid], mean: torch.Tensor,
+                stdev: torch.Tensor) -> torch.Tensor:
     """
 
-    :param x: must be monotonic increasing with equal increment on dim 0
+    :param x: must be monotonic increasing with equal increment on dim 0,
+        or pmf_grid(x), whose terms are reused across calls.
     :param mean:
     :param stdev:
     :return: p[k] = P(x[k] < X < x[k + 1]; mean, stdev)
     """
-
+    grid = pmf_grid(x)
     mu, sigma = lognorm_params_given_mean_stdev(mean, stdev)
-
-    dx = x[[1]] - x[[0]]
-    x = torch.cat([x, x[[-1]] + dx], dim=0)
-    x, mu, sigma = expand_all(x, mu, sigma)
-    c = torch.zeros_like(x)
-    incl = x > 0
-    c[incl] = torch.distributions.LogNormal(mu[incl], sigma[incl]).cdf(
-        x[incl]
-    )
-    p = c[1:] - c[:-1]
-
-    is_nan = torch.isnan(p)
-    if torch.any(is_nan):
-        print('--')
+    z = (grid.log_x - mu) / sigma
+    z = torch.where(grid.is_pos, z, torch.full_like(z, _z_floor))
+    p = _ndtr_diff(z)
+    check_anomaly('lognorm_pmf', p, x=grid.x_ext[:-1], mu=mu, sigma=sigma)
     return p
 
 
@@ -1248,16 +1740,263 @@ def mvnpdf_log(x, mu=None, sigma=None):
     return d.log_prob(x)
 
 
-def bootstrap(fun, samp, n_boot=100):
-    n_samp = len(samp)
-    ix = torch.randint(n_samp, (n_boot, n_samp))
+def _bootstrap_loop_chunk(fun, samp, ix_chunk):
+    """Call fun on each resample; module-level to be picklable"""
+    if torch.is_tensor(samp) or isinstance(samp, np.ndarray):
+        return [fun(samp[ix1]) for ix1 in ix_chunk]
+    return [fun([samp[s] for s in ix1]) for ix1 in ix_chunk]
+
+
+def _bootstrap_stack(res: list):
+    """Stack per-resample results into a tensor if possible"""
+    if all([torch.is_tensor(r) for r in res]):
+        try:
+            return torch.stack(res)
+        except RuntimeError:
+            return res
+    if all([np.isscalar(r) or isinstance(r, np.ndarray) for r in res]):
+        try:
+            return torch.as_tensor(np.stack(res))
+        except (ValueError, TypeError):
+            return res
+    return res
+
+
+def _bootstrap_cat(res_chunks: list):
+    if all([torch.is_tensor(r) for r in res_chunks]):
+        return torch.cat(res_chunks)
     res = []
-    for i_boot in range(n_boot):
-        samp1 = [samp[s] for s in ix[i_boot,:]]
-        res.append(fun(samp1))
+    for r in res_chunks:
+        res += list(r)
+    return res
+
+
+def _bootstrap_ix(n_samp, n_boot, chunksize, strata=None, generator=None):
+    """
+    Yield resampling indices in chunks of [chunksize, n_samp].
+    With strata, each observation is replaced by one from the same
+    stratum, so that stratum sizes are preserved.
+    """
+    for st in range(0, n_boot, chunksize):
+        n1 = min(chunksize, n_boot - st)
+        if strata is None:
+            yield torch.randint(n_samp, (n1, n_samp), generator=generator)
+        else:
+            ix = torch.empty((n1, n_samp), dtype=torch.long)
+            for ix_stratum in strata:
+                ix[:, ix_stratum] = ix_stratum[torch.randint(
+                    len(ix_stratum), (n1, len(ix_stratum)),
+                    generator=generator)]
+            yield ix
+
+
+def _jackknife_ix(n_samp, chunksize):
+    """Yield leave-one-out indices in chunks of [chunksize, n_samp - 1]"""
+    ix0 = torch.arange(n_samp - 1)
+    for st in range(0, n_samp, chunksize):
+        left_out = torch.arange(st, min(st + chunksize, n_samp))
+        yield ix0[None, :] + (ix0[None, :] >= left_out[:, None]).long()
+
+
+def _bootstrap_apply(fun, samp, ix_chunks, batched=None,
+                     executor='serial', n_jobs=None):
+    """
+    :param ix_chunks: iterable of [n_chunk, n_samp] LongTensor
+    :return: results concatenated over chunks; a tensor [n, ...] if
+    fun's outputs can be stacked, or a list otherwise.
+    """
+    ix_chunks = iter(ix_chunks)
+    res_chunks = []
+    if batched is not False and torch.is_tensor(samp):
+        for ix1 in ix_chunks:
+            samp1 = samp[ix1.to(samp.device)]
+            if batched is True:
+                res_chunks.append(fun(samp1))
+                continue
+            try:
+                res_chunks.append(torch.vmap(fun)(samp1))
+            except Exception:
+                if batched == 'vmap':
+                    raise
+                batched = False
+                res_chunks.append(_bootstrap_stack(
+                    _bootstrap_loop_chunk(fun, samp, ix1.to(samp.device))))
+                break
+        else:
+            return _bootstrap_cat(res_chunks)
+
+    def to_samp(ix1):
+        if isinstance(samp, np.ndarray):
+            return ix1.numpy()
+        if torch.is_tensor(samp):
+            return ix1.to(samp.device)
+        return ix1.tolist()
+
+    if executor == 'serial':
+        for ix1 in ix_chunks:
+            res_chunks.append(_bootstrap_stack(
+                _bootstrap_loop_chunk(fun, samp, to_samp(ix1))))
+    elif executor in ('thread', 'process'):
+        from concurrent import futures
+        if executor == 'thread':
+            pool = futures.ThreadPoolExecutor(n_jobs)
+        else:
+            pool = futures.ProcessPoolExecutor(n_jobs)
+        with pool:
+            futures1 = [
+                pool.submit(_bootstrap_loop_chunk, fun, samp, to_samp(ix1))
+                for ix1 in ix_chunks
+            ]
+            for future in futures1:
+                res_chunks.append(_bootstrap_stack(future.result()))
+    else:
+        raise ValueError('Unsupported executor=%s' % executor)
+    return _bootstrap_cat(res_chunks)
+
+
+def _bootstrap_chunksize(samp, n_samp, n_boot, max_memory):
+    """Number of resamples whose data and indices fit in max_memory"""
+    bytes_per_resample = 8 * n_samp
+    if torch.is_tensor(samp) or isinstance(samp, np.ndarray):
+        bytes_per_resample += samp.nbytes if isinstance(
+            samp, np.ndarray) else samp.numel() * samp.element_size()
+    return int(max(1, min(n_boot, max_memory // bytes_per_resample)))
+
+
+def bootstrap(fun, samp, n_boot=100, batched=None, strata=None, seed=None,
+              chunksize=None, max_memory=2 ** 28, executor='serial',
+              n_jobs=None, return_ix=True):
+    """
+    Apply fun to resamples (with replacement) of samp along the first dim.
+
+    Resamples are gathered by indexing in chunks. When samp is a tensor,
+    each chunk is passed to fun at once if possible:
+    with batched=True, fun must take [n_chunk, n_samp, ...] and return
+    [n_chunk, ...]; with batched=None (default), torch.vmap(fun) is
+    tried first, falling back to one call per resample.
+
+    EXAMPLE:
+    res, _ = bootstrap(lambda v: v.mean(0), torch.randn(1000, 3),
+                       n_boot=10000, seed=0, return_ix=False)
+
+    :param fun: takes one resample (same type as samp, or a list if samp
+    is a list) and returns its statistic.
+    :param samp: torch.Tensor, np.ndarray, or a list.
+    :param batched: None (try vmap), True (fun is batched), 'vmap'
+    (vmap without fallback), or False (one call per resample).
+    :param strata: labels of length n_samp; resample within each stratum.
+    :param seed: if given, resampling uses a torch.Generator seeded with
+    it; otherwise the global RNG, as torch.randint does.
+    :param chunksize: number of resamples per chunk; by default, as many
+    as fit in max_memory bytes.
+    :param executor: 'serial'|'thread'|'process', for calling fun on
+    each resample when it's not batched. With 'process', fun must be
+    picklable (e.g., defined at the module level).
+    :param return_ix: if False, return None for ix to save memory.
+    :return: res[i_boot, ...] (a tensor if fun's outputs can be
+    stacked; a list otherwise), ix[i_boot, i_samp]
+    """
+    n_samp = len(samp)
+    if chunksize is None:
+        chunksize = _bootstrap_chunksize(samp, n_samp, n_boot, max_memory)
+
+    generator = None
+    if seed is not None:
+        generator = torch.Generator().manual_seed(seed)
+
+    if strata is not None:
+        strata = np.unique(np.asarray(strata), return_inverse=True)[1]
+        strata = [torch.as_tensor(np.flatnonzero(strata == i))
+                  for i in range(strata.max() + 1)]
+
+    ix_chunks = _bootstrap_ix(n_samp, n_boot, chunksize, strata=strata,
+                              generator=generator)
+    ix = None
+    if return_ix:
+        ix_chunks = list(ix_chunks)
+        ix = torch.cat(ix_chunks)
+    res = _bootstrap_apply(fun, samp, ix_chunks, batched=batched,
+                           executor=executor, n_jobs=n_jobs)
     return res, ix
 
 
+def _quantile_each(res_sorted, q):
+    """
+    Linear-interpolated quantile of res_sorted along dim 0 at q, where q
+    may differ for each of the remaining elements.
+    """
+    n = res_sorted.shape[0]
+    pos = (q * (n - 1)).clamp(0, n - 1)
+    i0 = pos.floor().long()
+    i1 = (i0 + 1).clamp_max(n - 1)
+    w = pos - i0
+    v0 = res_sorted.gather(0, i0[None])[0]
+    v1 = res_sorted.gather(0, i1[None])[0]
+    return v0 + (v1 - v0) * w
+
+
+def bootstrap_ci(fun, samp, n_boot=10000, alpha=0.05, method='percentile',
+                 **kwargs):
+    """
+    Bootstrap confidence interval of fun(samp).
+    :param method: 'percentile' or 'bca' (bias-corrected and
+    accelerated; evaluates fun on n_samp jackknife resamples as well).
+    Use strata= for stratified resampling.
+    :param kwargs: fed to bootstrap()
+    :return: est, lo, hi: each of fun's output shape
+    """
+    batched = kwargs.get('batched', None)
+    kwargs['return_ix'] = False
+    res, _ = bootstrap(fun, samp, n_boot=n_boot, **kwargs)
+    if not torch.is_tensor(res):
+        raise ValueError('fun must return a tensor or a scalar '
+                         'to compute CI')
+    if not torch.is_floating_point(res):
+        res = res.to(get_dtype())
+
+    if batched is True:
+        est = fun(samp[None])[0]
+    elif torch.is_tensor(samp) or isinstance(samp, np.ndarray):
+        est = fun(samp)
+    else:
+        est = fun(list(samp))
+    est = torch.as_tensor(est, dtype=res.dtype, device=res.device)
+
+    q = torch.tensor([alpha / 2, 1. - alpha / 2], dtype=res.dtype,
+                     device=res.device)
+    q = q.reshape([2] + [1] * est.dim()).expand((2,) + est.shape)
+    if method == 'percentile':
+        pass
+    elif method == 'bca':
+        from torch.special import ndtr, ndtri
+
+        p0 = (res < est).to(res.dtype).mean(0)
+        z0 = ndtri(p0)
+
+        n_samp = len(samp)
+        chunksize = kwargs.get('chunksize', None)
+        if chunksize is None:
+            chunksize = _bootstrap_chunksize(
+                samp, n_samp - 1, n_samp, kwargs.get('max_memory', 2 ** 28))
+        res_jk = _bootstrap_apply(
+            fun, samp, _jackknife_ix(n_samp, chunksize), batched=batched,
+            executor=kwargs.get('executor', 'serial'),
+            n_jobs=kwargs.get('n_jobs', None))
+        res_jk = torch.as_tensor(res_jk, dtype=res.dtype, device=res.device)
+        d = res_jk.mean(0) - res_jk
+        accel = (d ** 3).sum(0) / (6. * (d ** 2).sum(0) ** 1.5)
+
+        z_q = ndtri(q)
+        q = ndtr(z0 + (z0 + z_q) / (1. - accel * (z0 + z_q)))
+    else:
+        raise ValueError('Unsupported method=%s' % method)
+
+    res_sorted = res.sort(0)[0]
+    lo = _quantile_each(res_sorted, q[0])
+    hi = _quantile_each(res_sorted, q[1])
+    return est, lo, hi
+
+
 #%% Linear algebra
 def ____LINEAR_ALGEBRA____():
     pass
@@ -1378,34 +2117,42 @@ def test_kron():
     print(res.shape)
 
 def block_diag_irregular(matrices):
-    # Block diagonal from a list of matrices that have different shapes.
-    # If they have identical shapes, use block_diag(), which is vectorized.
-
-    matrices = [p2st(m, 2) for m in matrices]
-
-    ns = torch.LongTensor([m.shape[0] for m in matrices])
-    n = torch.sum(ns)
-    batch_shape = matrices[0].shape[2:]
-
-    v = torch.zeros(torch.Size([n, n]) + batch_shape)
-    for ii, m1 in enumerate(matrices):
-        st = torch.sum(ns[:ii])
-        en = torch.sum(ns[:(ii + 1)])
-        v[st:en, st:en] = m1
-    return p2en(v, 2)
-
-    # cn0 = 0
-    # vs = []
-    # for n1, m1 in zip(ns, matrices):
-    #     vs.append(torch.cat((
-    #         torch.zeros(batch_shape + torch.Size([n1, cn0])),
-    #         m1,
-    #         torch.zeros(batch_shape + torch.Size([n1, n - cn0 - n1]))
-    #     ), dim=ndim_batch + 1))
-    #     # v[cn0:(cn0 + n1), cn0:(cn0 + n1)] = m1
-    #     cn0 += n1
-    # v = torch.cat(vs, dim=ndim_batch)
-    # return v
+    """
+    Block diagonal from a list of matrices that have different shapes.
+    If they have identical shapes, use block_diag() or BlockDiag.
+    :param matrices: list of [batch_shape..., n_row_i, n_col_i];
+        batch shapes are broadcast.
+    :return: [batch_shape..., sum(n_row_i), sum(n_col_i)]
+    """
+    matrices = [tensor(m) if not torch.is_tensor(m) else m
+                for m in matrices]
+    batch_shape = torch.broadcast_shapes(*[m.shape[:-2] for m in matrices])
+    dtype = matrices[0].dtype
+    for m1 in matrices[1:]:
+        dtype = torch.promote_types(dtype, m1.dtype)
+    device = matrices[0].device
+
+    rows = []
+    cols = []
+    n_row = 0
+    n_col = 0
+    for m1 in matrices:
+        r, c = m1.shape[-2:]
+        rows.append((torch.arange(r, device=device) + n_row
+                     ).repeat_interleave(c))
+        cols.append((torch.arange(c, device=device) + n_col).repeat(r))
+        n_row += r
+        n_col += c
+    vals = torch.cat([
+        m1.to(dtype).expand(batch_shape + m1.shape[-2:]).flatten(-2)
+        for m1 in matrices
+    ], -1)
+
+    v = torch.zeros(batch_shape + torch.Size([n_row, n_col]),
+                    dtype=dtype, device=device)
+    v[..., torch.cat(rows), torch.cat(cols)] = vals
+    return v
+
 
 def block_diag(m):
     """
@@ -1415,49 +2162,217 @@ def block_diag(m):
     should give a 12 x 8 matrix with blocks of 3 x 2 ones.
     Prepend batch dimensions if needed.
     You can also give a list of matrices.
+    To avoid materializing the zeros, use BlockDiag(m).
     :type m: torch.Tensor, list
     :rtype: torch.Tensor
     """
     if type(m) is list:
-        m = torch.cat([m1.unsqueeze(-3) for m1 in m], -3)
-
-    d = m.dim()
-    n = m.shape[-3]
-    siz0 = m.shape[:-3]
-    siz1 = m.shape[-2:]
-    m2 = m.unsqueeze(-2)
-    eye = attach_dim(torch.eye(n).unsqueeze(-2), d - 3, 1)
-    return (m2 * eye).reshape(
-        siz0 + torch.Size(tensor(siz1) * n)
-    )
+        m = torch.stack(m, -3)
+
+    n, r, c = m.shape[-3:]
+    # [..., n, r, c] -> [..., n, r, n, c] with zeros off the diagonal
+    res = torch.diag_embed(m.movedim(-3, -1), dim1=-4, dim2=-2)
+    return res.reshape(m.shape[:-3] + torch.Size([n * r, n * c]))
+
 
 def unblock_diag(m, n=None, size_block=None):
     """
-    The inverse of block_diag(). Not vectorized yet.
+    The inverse of block_diag().
     :param m: block diagonal matrix
     :param n: int. Number of blocks
     :size_block: torch.Size. Size of a block.
     :return: tensor unblocked such that the last sizes are [n] + size_block
     """
-    # not vectorized yet
     if size_block is None:
-        size_block = torch.Size(tensor(m.shape[-2:]) // n)
-    elif n is None:
-        n = m.shape[-2] // tensor(size_block[0])
-        assert n == m.shape[-1] // tensor(size_block[1])
+        if n is None:
+            raise ValueError('n or size_block must be given!')
+        size_block = torch.Size([m.shape[-2] // n, m.shape[-1] // n])
     else:
-        raise ValueError('n or size_block must be given!')
-    m = p2st(m, 2)
+        size_block = torch.Size(size_block)
+        if n is None:
+            n = m.shape[-2] // size_block[0]
+    assert m.shape[-2] == n * size_block[0]
+    assert m.shape[-1] == n * size_block[1]
+
+    r, c = size_block
+    return m.reshape(m.shape[:-2] + torch.Size([n, r, n, c])).diagonal(
+        dim1=-4, dim2=-2).movedim(-1, -3)
+
 
-    res = torch.zeros(torch.Size([n]) + size_block + m.shape[2:])
-    for i_block in range(n):
-        st_row = size_block[0] * i_block
-        en_row = size_block[0] * (i_block + 1)
-        st_col = size_block[1] * i_block
-        en_col = size_block[1] * (i_block + 1)
-        res[i_block,:] = m[st_row:en_row, st_col:en_col, :]
+class BlockDiag(object):
+    """
+    Block diagonal matrix that stores only its blocks.
+    blocks: [batch_shape..., n_block, n_row_block, n_col_block]
+    represents the [batch_shape..., n_block * n_row_block,
+    n_block * n_col_block] matrix block_diag(blocks).
+
+    EXAMPLE:
+    a = BlockDiag(torch.randn(4, 3, 3))
+    a @ torch.randn(12, 2)  # same as a.to_dense() @ ...
+    a.logdet()
+    """
+    def __init__(self, blocks):
+        if type(blocks) is list:
+            blocks = torch.stack(blocks, -3)
+        self.blocks = blocks
+
+    @classmethod
+    def from_dense(cls, m, n=None, size_block=None):
+        """Keeps only the diagonal blocks of m; see unblock_diag()"""
+        return cls(unblock_diag(m, n=n, size_block=size_block))
+
+    @property
+    def n_block(self):
+        return self.blocks.shape[-3]
+
+    @property
+    def size_block(self):
+        return self.blocks.shape[-2:]
+
+    @property
+    def batch_shape(self):
+        return self.blocks.shape[:-3]
+
+    @property
+    def shape(self):
+        n, r, c = self.blocks.shape[-3:]
+        return self.batch_shape + torch.Size([n * r, n * c])
+
+    @property
+    def dtype(self):
+        return self.blocks.dtype
+
+    @property
+    def device(self):
+        return self.blocks.device
+
+    def __repr__(self):
+        return 'BlockDiag(n_block=%d, size_block=%s, batch_shape=%s)' % (
+            self.n_block, tuple(self.size_block), tuple(self.batch_shape))
+
+    def to(self, *args, **kwargs):
+        return BlockDiag(self.blocks.to(*args, **kwargs))
+
+    def to_dense(self):
+        return block_diag(self.blocks)
+
+    def to_sparse(self):
+        """
+        :return: torch.sparse_coo_tensor of self.shape,
+            with the batch dimensions also sparse.
+        """
+        n, r, c = self.blocks.shape[-3:]
+        ix = torch.meshgrid(*[
+            torch.arange(s, device=self.device)
+            for s in self.blocks.shape
+        ], indexing='ij')
+        ix = [i.flatten() for i in ix]
+        i_block, i_row, i_col = ix[-3:]
+        indices = torch.stack(
+            ix[:-3] + [i_block * r + i_row, i_block * c + i_col])
+        return torch.sparse_coo_tensor(
+            indices, self.blocks.flatten(), self.shape).coalesce()
+
+    @property
+    def T(self):
+        return BlockDiag(self.blocks.transpose(-2, -1))
+
+    def _split(self, x, dim):
+        """[..., n * k, ...] -> [..., n, k, ...] at dim"""
+        n = self.n_block
+        siz = x.shape
+        dim = dim % x.dim()
+        return x.reshape(siz[:dim] + torch.Size([n, siz[dim] // n])
+                         + siz[dim + 1:])
+
+    def matmul(self, x):
+        """
+        :param x: BlockDiag with matching blocks, or
+            tensor [batch_shape..., n_block * n_col_block, k]
+        :return: BlockDiag or [batch_shape..., n_block * n_row_block, k]
+        """
+        if isinstance(x, BlockDiag):
+            return BlockDiag(self.blocks @ x.blocks)
+        res = self.blocks @ self._split(x, -2)
+        return res.flatten(-3, -2)
+
+    __matmul__ = matmul
+
+    def __rmatmul__(self, x):
+        # x @ self
+        res = self._split(x, -1).transpose(-3, -2) @ self.blocks
+        return res.transpose(-3, -2).flatten(-2)
+
+    def matvec(self, v):
+        """
+        :param v: [batch_shape..., n_block * n_col_block]
+        :return: [batch_shape..., n_block * n_row_block]
+        """
+        return self.matmul(v.unsqueeze(-1)).squeeze(-1)
+
+    def solve(self, b, is_vec=None):
+        """
+        Solves self @ x = b blockwise. Blocks must be square.
+        :param b: BlockDiag, [batch_shape..., n_block * n_row_block, k],
+            or [batch_shape..., n_block * n_row_block] (a vector).
+            Batch shapes are broadcast.
+        :param is_vec: whether b is a (batch of) vector(s). If None,
+            b is a vector if its last dim matches the matrix size and
+            the second last doesn't; b of shape [..., size, size] is
+            taken as a matrix.
+        """
+        if isinstance(b, BlockDiag):
+            return BlockDiag(torch.linalg.solve(self.blocks, b.blocks))
+        if is_vec is None:
+            size = self.shape[-1]
+            is_vec = b.shape[-1] == size and (
+                b.dim() == 1 or b.shape[-2] != size)
+        if is_vec:
+            b = b.unsqueeze(-1)
+        res = torch.linalg.solve(self.blocks, self._split(b, -2))
+        res = res.flatten(-3, -2)
+        return res.squeeze(-1) if is_vec else res
+
+    def inverse(self):
+        return BlockDiag(torch.linalg.inv(self.blocks))
+
+    def logdet(self):
+        """:return: [batch_shape...]"""
+        return torch.logdet(self.blocks).sum(-1)
+
+    def slogdet(self):
+        """:return: sign, logabsdet, each [batch_shape...]"""
+        sign, logabsdet = torch.linalg.slogdet(self.blocks)
+        return sign.prod(-1), logabsdet.sum(-1)
+
+    def diagonal(self):
+        """:return: [batch_shape..., n_block * min(size_block)]"""
+        return self.blocks.diagonal(dim1=-2, dim2=-1).flatten(-2)
+
+
+def test_block_diag_solve():
+    def randn(*shape):
+        return torch.randn(*shape, dtype=torch.double)
+
+    # batched blocks: [5] batch of 4 blocks of 3 x 3
+    a = BlockDiag(randn(5, 4, 3, 3) + 3 * torch.eye(3, dtype=torch.double))
+    dense = a.to_dense()
+    for b in [randn(12, 2), randn(5, 12, 2), randn(12, 12)]:  # matrices
+        x = a.solve(b)
+        assert x.shape == torch.Size([5, 12, b.shape[-1]])
+        assert torch.allclose(x, torch.linalg.solve(dense, b))
+    for b in [randn(12), randn(5, 12)]:  # vectors
+        x = a.solve(b)
+        assert x.shape == torch.Size([5, 12])
+        assert torch.allclose(
+            x, torch.linalg.solve(dense, b.unsqueeze(-1)).squeeze(-1))
+
+    # [12, 12] as a batch of 12 vectors, with unbatched blocks
+    a = BlockDiag(randn(4, 3, 3) + 3 * torch.eye(3, dtype=torch.double))
+    b = randn(12, 12)
+    x = a.solve(b, is_vec=True)
+    assert torch.allclose(x, torch.linalg.solve(a.to_dense(), b.T).T)
 
-    return p2en(res, 3)
 
 #%% Cross-validation
 def ____CROSS_VALIDATION____():
@@ -1539,7 +2454,99 @@ def vmpdf_prad_pconc(prad, ploc, pconc, normalize=True):
                  normalize=normalize)
 
 
-def vmpdf_a_given_b(a_prad, b_prad, pconc):
+class CircularKernel(object):
+    """
+    Circulant matrix p[a, b] = P(a | b) of the von Mises kernel on a
+    uniform circular grid of n points, stored as one column, with
+    matrix products applied by FFT circular convolution in O(n log n).
+    Differentiable w.r.t. pconc. Use circular_kernel() to reuse kernels
+    whose pconc doesn't require grad.
+
+    EXAMPLE:
+    k = circular_kernel(360, .9)
+    p_a = k @ p_b  # same as vmpdf_a_given_b(grid, grid, .9) @ p_b
+    """
+    def __init__(self, n: int, pconc, dtype=torch.double, device=None):
+        """
+        :param n: number of grid points
+        :param pconc: scalar; 0 to 1 maps to 0 to inf concentration
+        """
+        self.n = n
+        pconc = tensor(pconc, min_ndim=0, device=device).to(
+            dtype=dtype, device=device).reshape([])
+        self.pconc = pconc
+        cos = torch.cos(
+            2. * np.pi * torch.arange(n, dtype=pconc.dtype,
+                                      device=pconc.device) / n)
+        # col[k] = p[k, 0] = p[a, b] for a - b = k / n
+        self.col = torch.softmax(pconc2conc(pconc) * cos, -1)
+        self._col_fft = None
+
+    @property
+    def col_fft(self) -> torch.Tensor:
+        if self._col_fft is None:
+            self._col_fft = torch.fft.rfft(self.col)
+        return self._col_fft
+
+    def to_dense(self) -> torch.Tensor:
+        """:return: p[index_a, index_b]"""
+        ix = torch.arange(self.n, device=self.col.device)
+        return self.col[(ix[:, None] - ix[None, :]) % self.n]
+
+    def matmul(self, v: torch.Tensor) -> torch.Tensor:
+        """
+        :param v: [index_b, ...]
+        :return: (p @ v)[index_a, ...]
+        """
+        f = self.col_fft.reshape(self.col_fft.shape + (1,) * (v.dim() - 1))
+        return torch.fft.irfft(f * torch.fft.rfft(v, dim=0), self.n, dim=0)
+
+    __matmul__ = matmul
+
+    def __rmatmul__(self, v: torch.Tensor) -> torch.Tensor:
+        """
+        :param v: [..., index_a]
+        :return: (v @ p)[..., index_b]
+        """
+        return torch.fft.irfft(
+            self.col_fft.conj() * torch.fft.rfft(v, dim=-1), self.n, dim=-1)
+
+
+_circular_kernel_cache = {}
+
+
+def circular_kernel(n: int, pconc, dtype=torch.double, device=None
+                    ) -> CircularKernel:
+    """
+    CircularKernel, cached by (n, pconc, dtype, device) unless pconc
+    requires grad, in which case it's built anew to keep the graph.
+    """
+    if torch.is_tensor(pconc) and pconc.requires_grad:
+        return CircularKernel(n, pconc, dtype=dtype, device=device)
+    if device is None:
+        device = pconc.device if torch.is_tensor(pconc) else get_device()
+    key = (n, np.asarray(npy(pconc)).item(), dtype, torch.device(device))
+    if key not in _circular_kernel_cache:
+        if len(_circular_kernel_cache) > 256:
+            _circular_kernel_cache.clear()
+        _circular_kernel_cache[key] = CircularKernel(
+            n, pconc, dtype=dtype, device=device)
+    return _circular_kernel_cache[key]
+
+
+def is_uniform_circular_grid(prad: torch.Tensor, atol=1e-6) -> bool:
+    """
+    :param prad: between 0 and 1. Maps to 0 and 2*pi.
+    :return: True if prad[k] = prad[0] + k / n (mod 1)
+    """
+    prad = prad.flatten()
+    n = prad.numel()
+    d = (prad - prad[0]) - torch.arange(n, dtype=prad.dtype,
+                                        device=prad.device) / n
+    return bool(((d + .5) % 1. - .5).abs().max() <= atol)
+
+
+def vmpdf_a_given_b(a_prad, b_prad, pconc, as_operator=False):
     """
 
     :param a_prad: between 0 and 1. Maps to 0 and 2*pi.
@@ -1547,21 +2554,66 @@ def vmpdf_a_given_b(a_prad, b_prad, pconc):
     :param b_prad: between 0 and 1. Maps to 0 and 2*pi.
     :type b_prad: torch.Tensor
     :param pconc: float
+    :param as_operator: if True, return a CircularKernel that applies
+        p by FFT; a_prad and b_prad must be the same uniform grid.
     :return: p_a_given_b[index_a, index_b]
     :rtype: torch.Tensor
     """
-
+    same_grid = a_prad.numel() == b_prad.numel() and torch.equal(
+        a_prad.flatten(), b_prad.flatten()) and is_uniform_circular_grid(
+        a_prad)
+    if same_grid:
+        k = circular_kernel(a_prad.numel(), pconc, device=a_prad.device)
+        if as_operator:
+            return k
+        return k.to_dense()
+    elif as_operator:
+        raise ValueError('as_operator=True requires a_prad and b_prad '
+                         'to be the same uniform circular grid')
+
+    # The von Mises normalization constant cancels in sumto1(.., 1)
     dist = ((a_prad.reshape([-1, 1]) - b_prad.reshape([1, -1])) %
             1.).double()
-    return sumto1(vmpdf_prad_pconc(
-        dist.flatten(), tensor([0.]),
-        tensor(pconc)
-    ).reshape([a_prad.numel(), b_prad.numel()]), 1)
+    conc = pconc2conc(tensor(pconc, min_ndim=0, dtype=torch.double,
+                             device=dist.device))
+    return torch.softmax(conc * torch.cos(2. * np.pi * dist), 1)
 
 
-def vmpdf(x, mu, scale=None, normalize=True):
-    from .hyperspherical_vae.distributions import von_mises_fisher as vmf
+def log_i0e(x: torch.Tensor) -> torch.Tensor:
+    """
+    log of the exponentially scaled modified Bessel function of order 0,
+    log(exp(-|x|) I_0(x)), in torch with gradients; doesn't overflow.
+    """
+    return torch.log(torch.special.i0e(x))
+
 
+def vmpdf_log(x: torch.Tensor, mu: torch.Tensor, scale: torch.Tensor
+              ) -> torch.Tensor:
+    """
+    log density of the von Mises distribution on the circle,
+    without constructing VonMisesFisher or calling scipy.
+    :param x: [..., 2] unit vectors
+    :param mu: [..., 2] unit vectors
+    :param scale: [..., 1] concentration; broadcasts
+    :return: log p[...]
+    """
+    scale = scale + torch.zeros([1, 1], dtype=scale.dtype,
+                                device=scale.device)
+    return (
+        scale * ((mu * x).sum(-1, keepdim=True) - 1.)
+        - log_i0e(scale) - np.log(2. * np.pi)
+    ).squeeze(-1)
+
+
+def vmpdf(x, mu, scale=None, normalize=True):
+    """
+    Von Mises-Fisher density. In 2D (x.shape[-1] == 2), uses vmpdf_log();
+    otherwise constructs hyperspherical_vae's VonMisesFisher.
+    :param x: [..., m] unit vectors
+    :param mu: [..., m]; if scale is None, |mu| is taken as the scale.
+    :param scale: [..., 1] concentration
+    :param normalize: if True, sums to 1 across all elements
+    """
     if scale is None:
         # raise NotImplementedError('Using gradient not tested yet! (Seems '
         #                           'to gives NaN gradient when scale = 0)')
@@ -1569,8 +2621,13 @@ def vmpdf(x, mu, scale=None, normalize=True):
         mu = mu / scale
         # mu[scale[:,0] == 0, :] = 0.
 
-    vm = vmf.VonMisesFisher(mu, scale + torch.zeros([1,1], device=device0))
-    p = torch.exp(vm.log_prob(x)).clamp_min(0.)
+    if x.shape[-1] == 2:
+        p = torch.exp(vmpdf_log(x, mu, scale))
+    else:
+        from .hyperspherical_vae.distributions import von_mises_fisher as vmf
+        vm = vmf.VonMisesFisher(
+            mu, scale + torch.zeros([1, 1], device=get_device()))
+        p = torch.exp(vm.log_prob(x)).clamp_min(0.)
     # if scale == 0.:
     #     p = torch.ones_like(p) / p.shape[0]
     if normalize:
@@ -1150,6 +1150,24 @@ def plot_binned_ch(x0, ch, n_bin=9, **kw):
     
     return h, x, p, se
 
+
+def plot_binned_ch_sketch(sketch: np2.QuantileSketch, n_bin=9, **kw):
+    """
+    Same as plot_binned_ch() but from a QuantileSketch updated with
+    (x0, ch) in chunks, for data that don't fit in memory at once:
+    sketch = np2.QuantileSketch()
+    for x0, ch in sessions:
+        sketch.update(x0, ch)
+    plot_binned_ch_sketch(sketch)
+    """
+    x, p, sd, n = sketch.binned_summary(n_quantile=n_bin)
+    p = p[:, 0]
+    se = sd[:, 0] / np.sqrt(n)
+
+    h = plt.errorbar(x, p, yerr=se, **kw)
+
+    return h, x, p, se
+
 def ____Stats_Probability____():
     pass
 
@@ -11,31 +11,175 @@ Created on Tue Apr 17 15:11:31 2018
 import numpy as np
 from scipy import stats
 #%%
+def ____Distribution_Params____():
+    pass
+
+
+def _backend(*args):
+    """torch if any of args is a tensor; numpy otherwise"""
+    for v in args:
+        if type(v).__module__.split('.')[0] == 'torch':
+            import torch
+            return torch
+    return np
+
+
+def _asarray(xp, v, like=None):
+    """Convert v to xp's array type without copying when possible"""
+    if xp is np:
+        v = np.asarray(v)
+        return v if np.issubdtype(v.dtype, np.inexact) else v + 0.
+    if like is None or not xp.is_tensor(like):
+        like = None
+    if xp.is_tensor(v):
+        return v if xp.is_floating_point(v) else v + 0.
+    return xp.as_tensor(
+        v,
+        dtype=xp.get_default_dtype() if like is None else like.dtype,
+        device=None if like is None else like.device
+    )
+
+
+def _first_tensor(xp, args):
+    if xp is np:
+        return None
+    for v in args:
+        if xp.is_tensor(v):
+            return v
+    return None
+
 
 def ms2lognorm(m0, s0):
-    '''mean and stdev into mu and sigma params of the lognormal distribution'''
-    m = m0 + 0.
-    s = s0 + 0.
-    sig = np.sqrt(np.log((s / m) ** 2. + 1.))
-    mu = np.log(m) - sig ** 2. / 2.
+    """
+    Mean and stdev into mu and sigma params of the lognormal distribution.
+    Broadcasts; works with np.ndarray or torch.Tensor (keeping gradients).
+    :return: mu, sigma
+    """
+    xp = _backend(m0, s0)
+    like = _first_tensor(xp, (m0, s0))
+    m = _asarray(xp, m0, like)
+    s = _asarray(xp, s0, like)
+    sig = xp.sqrt(xp.log1p((s / m) ** 2.))
+    mu = xp.log(m) - sig ** 2. / 2.
     return mu, sig
 
+
 def lognorm2ms(mu0, sig0):
-    mu = mu0 + 0.
-    sig = sig0 + 0.
-    m = np.exp(mu + sig ** 2. / 2.)
-    s = np.sqrt((np.exp(sig ** 2.) - 1.) * np.exp(2. * mu + sig ** 2.))
+    """
+    mu and sigma params of the lognormal distribution into mean and stdev.
+    Broadcasts; works with np.ndarray or torch.Tensor (keeping gradients).
+    :return: mean, stdev
+    """
+    xp = _backend(mu0, sig0)
+    like = _first_tensor(xp, (mu0, sig0))
+    mu = _asarray(xp, mu0, like)
+    sig = _asarray(xp, sig0, like)
+    m = xp.exp(mu + sig ** 2. / 2.)
+    s = m * xp.sqrt(xp.expm1(sig ** 2.))
     return m, s
 
-def beta_mixture_of_betas(a0, b0, a, b):
-    p = np.arange(0., 1., 0.01)
-    n = p.size
-    pp = np.zeros(n)
-    
-    raise ValueError('Not implemented yet!')
-    
-    # for [] = stats.beta.pdf(p, a, b)
-    pass
+
+def betaln(a, b):
+    """log of the beta function; np.ndarray or torch.Tensor"""
+    xp = _backend(a, b)
+    if xp is np:
+        from scipy import special
+        return special.betaln(a, b)
+    like = _first_tensor(xp, (a, b))
+    a = _asarray(xp, a, like)
+    b = _asarray(xp, b, like)
+    return xp.lgamma(a) + xp.lgamma(b) - xp.lgamma(a + b)
+
+
+def beta_logpdf(x, a, b):
+    """
+    log density of Beta(a, b) at x; broadcasts.
+    Works with np.ndarray or torch.Tensor (keeping gradients).
+    """
+    xp = _backend(x, a, b)
+    like = _first_tensor(xp, (x, a, b))
+    x, a, b = [_asarray(xp, v, like) for v in (x, a, b)]
+    return (
+        (a - 1.) * xp.log(x) + (b - 1.) * xp.log1p(-x) - betaln(a, b)
+    )
+
+
+def _tanh_sinh_nodes(n_grid, log_u_min):
+    """
+    Tanh-sinh (double exponential) nodes on (0, 1): u = 1 / (1 + e^-z),
+    z = pi sinh(tau), tau on an even grid that spans u from exp(log_u_min)
+    to 1 - exp(log_u_min). Integrands with power singularities at both ends
+    converge quickly.
+    :return: log u, log (1 - u), log weight (du / dtau * dtau)
+    """
+    tau_max = np.arcsinh(-log_u_min / np.pi)
+    tau, dtau = np.linspace(-tau_max, tau_max, n_grid, retstep=True)
+    z = np.pi * np.sinh(tau)
+    log_u = -np.logaddexp(0., -z)
+    log_1mu = -np.logaddexp(0., z)
+    log_w = log_u + log_1mu + np.log(np.pi * np.cosh(tau) * dtau)
+    return log_u, log_1mu, log_w
+
+
+def beta_mixture_of_betas(a0, b0, a, b, p=None, n_grid=100):
+    """
+    Density of a scale mixture of betas, p = q * r, where
+    q ~ Beta(a0, b0) and r ~ Beta(a, b):
+    pp(p) = int_p^1 Beta(q; a0, b0) Beta(p / q; a, b) / q dq
+
+    a0, b0, a, b broadcast against each other, so a grid of parameters,
+    e.g., a0[:, None, None, None], b0[None, :, None, None], ...,
+    is evaluated in one pass.
+    The integral is over u in (0, 1) with q = p ** (1 - u), which leaves
+    power singularities (1 - q) ** (b0 - 1) and (1 - r) ** (b - 1) at
+    the ends of u, and uses tanh-sinh quadrature with n_grid points,
+    which handles them. In float64 with n_grid=100, the relative error
+    is < 1e-10 for parameters in [0.2, 20] and p in [1e-6, 1 - 1e-6];
+    larger parameters concentrate the integrand and need more points
+    (e.g., 1e-3 at n_grid=100 and 1e-12 at n_grid=200 for all 50).
+    In float32, it is < 1e-4 except for p within ~1e-4 of 1, where
+    rounding p loses precision in 1 - p.
+    Works with np.ndarray or torch.Tensor (keeping gradients).
+
+    :param p: values at which to evaluate the density.
+        Defaults to n_grid midpoints between 0 and 1.
+    :param n_grid: number of quadrature points (and of p if not given).
+    :return: pp[..., i] = density at p[i], p
+    """
+    xp = _backend(a0, b0, a, b, p)
+    like = _first_tensor(xp, (a0, b0, a, b, p))
+    a0, b0, a, b = [_asarray(xp, v, like)[..., None, None]
+                    for v in (a0, b0, a, b)]
+    if p is None:
+        p = (np.arange(n_grid) + .5) / n_grid
+        if xp is not np:
+            p = xp.as_tensor(p, dtype=a0.dtype, device=a0.device)
+    else:
+        p = _asarray(xp, p, like)
+
+    # Nodes reach closer to the ends in float64; in float32,
+    # u * L below must not underflow.
+    is_double = (xp is np or a0.dtype == xp.float64)
+    log_u, log_1mu, log_w = [
+        v if xp is np else xp.as_tensor(v, dtype=a0.dtype, device=a0.device)
+        for v in _tanh_sinh_nodes(n_grid, -230. if is_double else -40.)]
+
+    # With L = -log p, q = exp(-(1 - u) L) and r = p / q = exp(-u L),
+    # so 1 - q and 1 - r are expm1's without cancellation.
+    # dq / q = L du.
+    inside = (p > 0.) & (p < 1.)
+    log_l = xp.log(-xp.log(xp.where(inside, p, xp.full_like(p, .5))))
+    t = xp.exp(log_1mu[None, :] + log_l[:, None])  # -log q
+    s = xp.exp(log_u[None, :] + log_l[:, None])  # -log r
+    log_integrand = (
+        - (a0 - 1.) * t + (b0 - 1.) * xp.log(-xp.expm1(-t))
+        - (a - 1.) * s + (b - 1.) * xp.log(-xp.expm1(-s))
+        - betaln(a0, b0) - betaln(a, b)
+        + log_l[:, None] + log_w[None, :]
+    )
+    pp = xp.exp(log_integrand).sum(-1)
+    pp = xp.where(inside, pp, xp.zeros_like(pp))
+    return pp, p
 
 
 def ____Regression____():
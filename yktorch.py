@@ -629,11 +629,11 @@ def enforce_float_tensor(v: Union[torch.Tensor, np.ndarray], device=None
     :rtype: torch.DoubleTensor, torch.FloatTensor
     """
     if device is None:
-        device = default_device
+        device = npt.get_device(default_device)
     if not torch.is_tensor(v):
-        return torch.tensor(v, dtype=torch.get_default_dtype(), device=device)
+        return torch.tensor(v, dtype=npt.get_dtype(), device=device)
     elif not torch.is_floating_point(v):
-        return v.float()
+        return v.to(npt.get_dtype())
     else:
         return v
 